@@ -12,11 +12,12 @@ from .base import Sqla
 try:
     imp.find_module('settings')
 except ImportError:
-    sys.path.insert(os.path.dirname(os.path.abspath(__file__)), 0)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 import settings
 
 
+''' Nothing touches the database until engine or session is first used. '''
 sqla = Sqla(settings, 'default')
-engine = sqla.engines['default']
-session = sqla.sessions['default']
+engine = sqla.engine('default')
+session = sqla.session('default')
@@ -1,20 +1,125 @@
 #!/usr/bin/python
 # coding: utf-8
+import itertools
+import threading
+
 from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session,\
+from sqlalchemy.orm import Session,\
+                           scoped_session,\
                            sessionmaker
+from sqlalchemy.sql.expression import Select,\
+                                      UpdateBase
 from sqlalchemy.engine.url import URL
 
 class SqlaException(Exception):
     pass
 
+class ReplicaSet(object):
+    ''' Read replicas of one database config.
+
+    policy: 'round_robin' cycles through the replicas, 'least_busy' picks
+    the one with the fewest connections checked out of its pool.
+    '''
+    POLICIES = ('round_robin', 'least_busy')
+
+    def __init__(self, engines, policy='round_robin'):
+        if policy not in self.POLICIES:
+            raise SqlaException('Unknow replica policy %s' % policy)
+        self.engines = engines
+        self.policy = policy
+        self._cycle = itertools.cycle(engines)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.engines)
+
+    def choose(self):
+        if self.policy == 'least_busy':
+            return min(self.engines,
+                key=lambda e: getattr(e.pool, 'checkedout', lambda: 0)())
+        with self._lock:
+            return self._cycle.next()
+
+class RoutingSession(Session):
+    ''' Session sending reads to a replica and writes to the primary.
+
+    Flushes, INSERT/UPDATE/DELETE, SELECT ... FOR UPDATE and textual SQL
+    go to the primary (the session bind). Once the session has written,
+    it sticks to the primary until it is closed, so a request reads its
+    own writes.
+    '''
+
+    def __init__(self, replicas=None, **kw):
+        super(RoutingSession, self).__init__(**kw)
+        self.replicas = replicas
+        self.use_primary = False
+
+    def _is_read(self, clause):
+        return isinstance(clause, Select) and clause._for_update_arg is None
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self.replicas or self.use_primary:
+            pass
+        elif self._flushing or isinstance(clause, UpdateBase):
+            self.use_primary = True
+        elif self._is_read(clause):
+            return self.replicas.choose()
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def close(self):
+        super(RoutingSession, self).close()
+        self.use_primary = False
+
+class LazyDict(dict):
+    ''' dict building missing keys through build(key) on first access. '''
+
+    def __init__(self, build):
+        super(LazyDict, self).__init__()
+        self._build = build
+
+    def __missing__(self, key):
+        self._build(key)
+        return dict.__getitem__(self, key)
+
+class LazyProxy(object):
+    ''' Stand-in for the object returned by factory(), which is only
+    called on first use. Attribute access and calls are forwarded.
+    '''
+    __slots__ = ('_factory', '_target')
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_target', None)
+
+    def _get_target(self):
+        target = object.__getattribute__(self, '_target')
+        if target is None:
+            target = object.__getattribute__(self, '_factory')()
+            object.__setattr__(self, '_target', target)
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._get_target(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_target(), name, value)
+
+    def __call__(self, *a, **kw):
+        return self._get_target()(*a, **kw)
+
+    def __repr__(self):
+        if object.__getattribute__(self, '_target') is None:
+            return '<LazyProxy (not created)>'
+        return repr(self._get_target())
+
 class Sqla(object):
     DB_CONFS = None
     DEBUG = None
 
-    engines = {}
-    connects = {}
-    sessions = {}
+    engines = None
+    connects = None
+    sessions = None
+    replicas = None
 
     def __init__(self, settings, db_conf, ekw={}, skw={}, *a, **kw):
         """ Initialize GameCC Sqla Model
@@ -29,16 +134,54 @@ class Sqla(object):
             raise SqlaException('Can not find Database Setting in the settings file.')
         self.DB_CONFS = getattr(settings, 'DB_CONFS', None)
         self.DEBUG = getattr(settings, 'DB_DEBUG', False)
-        self.__call__(db_conf, ekw=ekw, skw=skw, *a, **kw)
+        if db_conf not in self.DB_CONFS:
+            raise SqlaException('Unknow database config')
+
+        ''' engines and sessions are built on first access '''
+        self._lock = threading.RLock()
+        build = lambda key: self.__call__(key, ekw=ekw, skw=skw)
+        self.connects = LazyDict(build)
+        self.engines = LazyDict(build)
+        self.sessions = LazyDict(build)
+        self.replicas = LazyDict(build)
+
+    def engine(self, db_conf):
+        ''' Proxy of engines[db_conf], created on first use. '''
+        return LazyProxy(lambda: self.engines[db_conf])
+
+    def session(self, db_conf):
+        ''' Proxy of sessions[db_conf], created on first use. '''
+        return LazyProxy(lambda: self.sessions[db_conf])
 
     def __call__(self, db_conf, ekw={}, skw={}, *a, **kw):
-        """
+        """ Build the engine and session of a DB_CONFS entry.
+
+        An entry may list read replicas, each a URL dict like the entry
+        itself (several SQLite files work for local testing):
+
+            'default': dict(drivername='mysql', ..., replicas=[
+                dict(drivername='mysql', host='replica1', ...),
+            ], replica_policy='round_robin')
         """
         if db_conf in self.DB_CONFS:
-            self.connects[db_conf] = URL(**self.DB_CONFS[db_conf])
-            self.engines[db_conf] = create_engine(self.connects[db_conf],
-                    echo=self.DEBUG, **ekw)
-            self.sessions[db_conf] = scoped_session(sessionmaker(
-                bind=self.engines[db_conf], **skw))
+            with self._lock:
+                if db_conf in self.sessions:
+                    return
+                self._create(db_conf, ekw, skw)
         else:
             raise SqlaException('Unknow database config')
+
+    def _create(self, db_conf, ekw, skw):
+        conf = dict(self.DB_CONFS[db_conf])
+        replicas = conf.pop('replicas', None) or []
+        policy = conf.pop('replica_policy', 'round_robin')
+
+        self.connects[db_conf] = URL(**conf)
+        self.engines[db_conf] = create_engine(self.connects[db_conf],
+                echo=self.DEBUG, **ekw)
+        self.replicas[db_conf] = ReplicaSet([
+            create_engine(URL(**replica), echo=self.DEBUG, **ekw)
+            for replica in replicas], policy) if replicas else None
+        self.sessions[db_conf] = scoped_session(sessionmaker(
+            class_=RoutingSession, replicas=self.replicas[db_conf],
+            bind=self.engines[db_conf], **skw))
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Helpers shared by the benchmark scripts. """
+import os
+import sys
+import time
+import importlib
+
+from sqlalchemy import create_engine,\
+                       event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.mysql import TINYINT
+
+''' directory holding the package, settings.py and core/ '''
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_package(name):
+    ''' Import <name>.orm from ROOT and return the package. '''
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    importlib.import_module('%s.orm' % name)
+    return sys.modules[name]
+
+def sqlite_engine(path=''):
+    ''' SQLite engine with MySQL's unix_timestamp(), used by the column
+    defaults in schema.py.
+    '''
+    engine = create_engine('sqlite://%s' % (path and '/' + path))
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_conn, record):
+        dbapi_conn.create_function('unix_timestamp', 0, lambda: int(time.time()))
+    return engine
+
+@compiles(TINYINT, 'sqlite')
+def _tinyint(type_, compiler, **kw):
+    ''' schema.py's MySQL TINYINT, for create_all() on SQLite '''
+    return 'TINYINT'
+
+class StatementCounter(object):
+    ''' Number of statements an engine ran since the last reset(). '''
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *a):
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+def timed(fn, *a, **kw):
+    ''' (seconds, result) of fn(*a, **kw). '''
+    start = time.time()
+    rv = fn(*a, **kw)
+    return time.time() - start, rv
@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Cold-import cost of the package, lazy vs eager.
+
+    python benchmarks/import_time.py [-n 20] [-p sqla]
+
+`lazy` is what a worker or CLI tool pays for `import sqla, sqla.orm`
+now. `eager` also maps, configures and connects, the way importing
+used to, and is what the first database use still pays.
+"""
+import sys
+import time
+import subprocess
+from optparse import OptionParser
+
+from common import ROOT
+
+CASES = (
+    ('lazy', 'import %(p)s, %(p)s.orm'),
+    ('eager', 'import %(p)s, %(p)s.orm, mako.template, core.hash\n'
+              'from sqlalchemy.orm import configure_mappers\n'
+              '%(p)s.orm.setup_mappers(); configure_mappers()\n'
+              '%(p)s.engine.connect().close()'),
+)
+
+def run(code):
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code], cwd=ROOT)
+    return (time.time() - start) * 1000
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', dest='runs', type='int', default=20)
+    parser.add_option('-p', dest='package', default='sqla')
+    opts, args = parser.parse_args()
+
+    ''' warm the .pyc files first '''
+    run(CASES[-1][1] % dict(p=opts.package))
+    for name, code in CASES:
+        times = sorted(run(code % dict(p=opts.package)) for i in range(opts.runs))
+        print '%-6s min %7.1f ms  median %7.1f ms' % (
+            name, times[0], times[len(times) / 2])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Listing pages of NewsDetail/GameDetail: deferred vs undefer vs listing().
+
+    python benchmarks/listing.py [-n 3000] [-s 50] [-p sqla]
+
+deferred  touches .category/.genre and .content per row (2 queries a row)
+undefer   undefers them, one correlated subquery per row and column
+listing   AbstractListingModel.listing(..., with_content=True)
+"""
+from optparse import OptionParser
+
+from sqlalchemy.orm import sessionmaker,\
+                           undefer
+
+from common import load_package, sqlite_engine, StatementCounter, timed
+
+
+def populate(schema, engine, rows):
+    conn = engine.connect()
+    conn.execute(schema.news_category.insert(), [dict(
+        segment='c%d' % i, name='category %d' % i) for i in range(20)])
+    conn.execute(schema.news_detail.insert(), [dict(
+        category_id=i % 20 + 1, user_id=1, headline='news %d' % i)
+        for i in range(rows)])
+    conn.execute(schema.news_content.insert(), [dict(
+        news_id=i + 1, content='body %d ' % i * 50) for i in range(rows)])
+    conn.execute(schema.game_taxonomy.insert(), [dict(
+        is_genre=1, segment='g%d' % i, name='genre %d' % i) for i in range(20)])
+    conn.execute(schema.game_detail.insert(), [dict(
+        genre_id=i % 20 + 1, headline='game %d' % i) for i in range(rows)])
+    conn.execute(schema.game_content.insert(), [dict(
+        game_id=i + 1, content='body %d ' % i * 50) for i in range(rows)])
+    conn.close()
+
+def walk(db, model, name, rows, size, mode):
+    for start in range(0, rows, size):
+        if mode == 'listing':
+            page = model.listing(db, start, start + size, with_content=True)
+        else:
+            query = db.query(model).order_by(model.id.desc())
+            if mode == 'undefer':
+                query = query.options(undefer(name), undefer('content'))
+            page = query[start:start + size]
+        for detail in page:
+            getattr(detail, name), detail.content
+        db.expunge_all()
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', dest='rows', type='int', default=3000)
+    parser.add_option('-s', dest='size', type='int', default=50)
+    parser.add_option('-p', dest='package', default='sqla')
+    opts, args = parser.parse_args()
+
+    package = load_package(opts.package)
+    schema, orm = package.schema, package.orm
+    engine = sqlite_engine()
+    schema.metadata.create_all(engine, tables=[schema.news_category,
+        schema.news_detail, schema.news_content, schema.game_taxonomy,
+        schema.game_detail, schema.game_content])
+    populate(schema, engine, opts.rows)
+    counter = StatementCounter(engine)
+    db = sessionmaker(bind=engine)()
+
+    print '%-12s %-9s %10s %12s' % ('model', 'mode', 'seconds', 'statements')
+    for model, name in ((orm.NewsDetail, 'category'), (orm.GameDetail, 'genre')):
+        for mode in ('deferred', 'undefer', 'listing'):
+            counter.reset()
+            seconds, rv = timed(walk, db, model, name, opts.rows, opts.size, mode)
+            print '%-12s %-9s %10.3f %12d' % (
+                model.__name__, mode, seconds, counter.count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Request latency under concurrent logins, inline vs HashExecutor.
+
+    python benchmarks/login_latency.py [-l 8] [-o 8] [-n 50] [-p sqla]
+
+Threads stand in for a threaded WSGI server: `-l` of them verify
+passwords in a loop (logins), `-o` of them serve a small CPU-bound page
+(others). Reported are p50/p99 of both kinds of request; hashing inline
+holds the GIL for the whole KDF, so the others queue behind every login.
+"""
+import time
+import threading
+from optparse import OptionParser
+
+from common import load_package
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def other_request():
+    sum(i * i for i in xrange(20000))
+
+def run(hashing, executor, logins, others, requests):
+    secret = 'benchmark-secret'
+    hashed = hashing.hash_password(u'password', secret)
+    times = dict(login=[], other=[])
+    lock = threading.Lock()
+
+    def worker(kind):
+        local = []
+        for i in range(requests):
+            start = time.time()
+            if kind == 'login':
+                assert hashing.verify_password(u'password', secret, hashed,
+                    executor)
+            else:
+                other_request()
+            local.append((time.time() - start) * 1000)
+        with lock:
+            times[kind].extend(local)
+
+    threads = [threading.Thread(target=worker, args=('login',))
+        for i in range(logins)]
+    threads += [threading.Thread(target=worker, args=('other',))
+        for i in range(others)]
+    start = time.time()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    return time.time() - start, times
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-l', dest='logins', type='int', default=8)
+    parser.add_option('-o', dest='others', type='int', default=8)
+    parser.add_option('-n', dest='requests', type='int', default=50)
+    parser.add_option('-p', dest='package', default='sqla')
+    opts, args = parser.parse_args()
+
+    load_package(opts.package)
+    hashing = __import__('%s.hashing' % opts.package, fromlist=['hashing'])
+    executor = hashing.HashExecutor().start()
+    executor.hash(u'warm', 'up')
+
+    print '%-10s %8s %12s %12s %12s %12s' % ('mode', 'seconds',
+        'login p50', 'login p99', 'other p50', 'other p99')
+    for mode, ex in (('inline', None), ('executor', executor)):
+        elapsed, times = run(hashing, ex, opts.logins, opts.others,
+            opts.requests)
+        print '%-10s %8.2f %12.1f %12.1f %12.1f %12.1f' % (mode, elapsed,
+            percentile(times['login'], 50), percentile(times['login'], 99),
+            percentile(times['other'], 50), percentile(times['other'], 99))
+    executor.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# coding: utf-8
+""" game_detail score totals: incremental rollup vs recomputation.
+
+    python benchmarks/score_rollup.py [-g 2000] [-m 50] [-w 500] [-p sqla]
+
+incremental  commits `-w` GameMark writes (new scores, rescoring, deletes),
+             each keeping its game's totals in step through rollup.py;
+             ms / op is per write
+recompute    the GROUP BY over every mark that used to follow such writes,
+             as rollup.rebuild() and as one UPDATE ... (SELECT ...);
+             ms / op is per recomputation
+Both end with the same totals, which the script checks.
+"""
+import random
+from optparse import OptionParser
+
+from sqlalchemy import select,\
+                       func,\
+                       and_
+from sqlalchemy.orm import sessionmaker
+
+from common import load_package, sqlite_engine, StatementCounter, timed
+
+
+def populate(schema, engine, games, marks):
+    conn = engine.connect()
+    conn.execute(schema.game_taxonomy.insert(), [dict(
+        is_genre=1, segment='g', name='genre')])
+    conn.execute(schema.game_detail.insert(), [dict(
+        genre_id=1, headline='game %d' % i) for i in range(games)])
+    conn.execute(schema.game_mark.insert(), [dict(
+        user_id=u + 1, game_id=g + 1, scored=1, score=random.randint(1, 10))
+        for g in range(games) for u in range(marks)])
+    conn.close()
+
+def incremental(orm, db, games, marks, writes):
+    for i in range(writes):
+        game_id = random.randint(1, games)
+        kind = i % 3
+        if kind == 0:
+            db.add(orm.GameMark(user_id=marks + i + 1, game_id=game_id,
+                scored=1, score=random.randint(1, 10)))
+        else:
+            mark = db.query(orm.GameMark).filter_by(game_id=game_id).first()
+            if kind == 1:
+                mark.score = random.randint(1, 10)
+            else:
+                db.delete(mark)
+        db.commit()
+
+def recompute_update(schema, engine):
+    gd, gm = schema.game_detail, schema.game_mark
+    scored = and_(gm.c.game_id == gd.c.id, gm.c.scored != 0)
+    engine.execute(gd.update().values(
+        count_score=select([func.count()]).where(scored).as_scalar(),
+        total_score=select([func.coalesce(func.sum(gm.c.score), 0)])\
+            .where(scored).as_scalar()))
+
+def totals(schema, engine):
+    gd = schema.game_detail
+    return engine.execute(select([gd.c.id, gd.c.count_score,
+        gd.c.total_score]).order_by(gd.c.id)).fetchall()
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-g', dest='games', type='int', default=2000)
+    parser.add_option('-m', dest='marks', type='int', default=50)
+    parser.add_option('-w', dest='writes', type='int', default=500)
+    parser.add_option('-p', dest='package', default='sqla')
+    opts, args = parser.parse_args()
+
+    package = load_package(opts.package)
+    schema, orm, rollup = package.schema, package.orm, package.rollup
+    engine = sqlite_engine()
+    schema.metadata.create_all(engine, tables=[schema.user_base,
+        schema.game_taxonomy, schema.game_detail, schema.game_mark])
+    populate(schema, engine, opts.games, opts.marks)
+    rollup.rebuild(engine)
+    counter = StatementCounter(engine)
+    db = sessionmaker(bind=engine)()
+
+    print '%-20s %10s %12s %12s' % ('mode', 'seconds', 'statements',
+        'ms / op')
+    counter.reset()
+    seconds, rv = timed(incremental, orm, db, opts.games, opts.marks,
+        opts.writes)
+    print '%-20s %10.3f %12d %12.3f' % ('incremental', seconds,
+        counter.count, seconds * 1000 / opts.writes)
+    expected = totals(schema, engine)
+
+    for name, fn, args in (('recompute rebuild', rollup.rebuild, (engine,)),
+            ('recompute update', recompute_update, (schema, engine))):
+        counter.reset()
+        seconds, rv = timed(fn, *args)
+        print '%-20s %10.3f %12d %12.3f' % (name, seconds, counter.count,
+            seconds * 1000)
+        assert totals(schema, engine) == expected, name
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,72 @@
 #!/usr/bin/python
 # coding: utf-8
 from bottle import HTTPError,\
-                   PluginError
-from sqlalchemy.orm import sessionmaker,\
-                           scoped_session
+                   PluginError,\
+                   request
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
-from . import engine
+from . import engine,\
+              sqla
+from .base import RoutingSession
+from .sqlstats import SQLProfiler
+
+class SessionHandle(object):
+    ''' Request-scoped stand-in for a session.
+
+    The session is created on first attribute access, and a pool
+    connection is only checked out when it first runs SQL.
+    '''
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._session = None
+
+    def __call__(self):
+        ''' scoped_session compatibility: db() returns the session. '''
+        if self._session is None:
+            self._session = self._factory()
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self(), name)
+
+    @property
+    def used(self):
+        ''' True when commit/rollback has something to do. '''
+        session = self._session
+        if session is None:
+            return False
+        return bool(session.info.get('began') or session.new\
+            or session.dirty or session.deleted)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
 class SQLAlchemyPlugin(object):
     name = 'sqlalchemy'
     api = '2'
 
-    def __init__(self, engine, keyword='db', autoflush=False, autocommit=False):
+    def __init__(self, engine, keyword='db', autoflush=False, autocommit=False,
+            profile=False, n_plus_one=10, replicas=None):
+        """
+        Args:
+            replicas: ReplicaSet reads are routed to (see RoutingSession),
+                or a function returning it or None, called on first use
+            profile: record the SQL of each request; the RequestStats are
+                stored in request.environ['sqlalchemy.stats'] and merged
+                into self.profiler.histogram (see SQLProfiler.dump)
+            n_plus_one: flag fingerprints repeated more often than this
+        """
         self.engine = engine
         self.keyword = keyword
         self.autoflush = autoflush
         self.autocommit = autocommit
+        self.profiler = SQLProfiler(n_plus_one) if profile else None
+        self.replicas = replicas
+        self._sessionmaker = None
 
     def setup(self, app):
         for other in app.plugins:
@@ -25,24 +76,51 @@ class SQLAlchemyPlugin(object):
                 raise PluginError('Found another sqlalchemy plugin with\
                     conflicting settings (non-unfque keyword).')
 
+    def _replicas(self):
+        if callable(self.replicas):
+            self.replicas = self.replicas()
+        return self.replicas
+
+    def engines(self):
+        ''' The primary engine, then the replica engines. '''
+        replicas = self._replicas()
+        return [self.engine.engine] + (replicas.engines if replicas else [])
+
+    def create_session(self):
+        if self._sessionmaker is None:
+            self._sessionmaker = sessionmaker(class_=RoutingSession,
+                replicas=self._replicas(), bind=self.engine.engine,
+                autoflush=self.autoflush)
+            event.listen(self._sessionmaker, 'after_begin', _mark_began)
+        return self._sessionmaker()
+
     def apply(self, callback, context):
         import inspect
         args = inspect.getargspec(context.callback)[0]
-        if self.keyword not in args: 
+        if self.keyword not in args:
             return callback
 
-        session = scoped_session(sessionmaker(bind=self.engine, autoflush=self.autoflush))
         def warpper(*a, **kw):
+            session = SessionHandle(self.create_session)
             kw[self.keyword] = session
+            if self.profiler:
+                for engine in self.engines():
+                    self.profiler.attach(engine)
+                request.environ['sqlalchemy.stats'] = self.profiler.begin()
             try:
                 rv = callback(*a, **kw)
-                if self.autocommit: session.commit()
+                if self.autocommit and session.used: session.commit()
             except SQLAlchemyError, e:
-                session.rollback()
+                if session.used: session.rollback()
                 raise HTTPError(500, e)
             finally:
                 session.close()
+                if self.profiler: self.profiler.end()
             return rv
         return warpper
 
-plugin_sqlalchemy = SQLAlchemyPlugin(engine=engine, autocommit=False)
+def _mark_began(session, transaction, connection):
+    session.info['began'] = True
+
+plugin_sqlalchemy = SQLAlchemyPlugin(engine=engine, autocommit=False,
+    replicas=lambda: sqla.replicas['default'])
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# coding: utf-8
+import time
+import threading
+from collections import OrderedDict
+
+from .base import SqlaException
+
+
+class LRUCache(object):
+    ''' Thread-safe bounded mapping, least recently used out first.
+
+    ttl: seconds an entry stays valid; None keeps it until evicted.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires < time.time():
+                return default
+            self._items[key] = item
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._items)
+
+class CommitEviction(object):
+    ''' Evicts keys of `cache` now and again when the session commits, in
+    case a reader cached the old value in between. The keys wait in
+    session.info[info_key] and are dropped if the session rolls back,
+    as its rows did not change.
+    '''
+
+    def __init__(self, cache, info_key):
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+        self.cache = cache
+        self.info_key = info_key
+        event.listen(Session, 'after_commit', self.after_commit)
+        event.listen(Session, 'after_rollback', self.after_rollback)
+
+    def forget(self, session, *keys):
+        ''' session: evicts keys again when it commits; None for now only '''
+        for key in keys:
+            self.cache.pop(key)
+        if session is not None:
+            session.info.setdefault(self.info_key, set()).update(keys)
+
+    def after_commit(self, session):
+        for key in session.info.pop(self.info_key, ()):
+            self.cache.pop(key)
+
+    def after_rollback(self, session):
+        session.info.pop(self.info_key, None)
+
+def _normalize(value):
+    ''' One key for 'game' and u'game', and for 1, 1L and True. '''
+    if isinstance(value, (bool, int, long)):
+        return int(value)
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+class EntityCache(object):
+    ''' Second-level cache of read-mostly mapped classes.
+
+    Rows are stored as {attribute: value} dicts, so any backend with
+    get(key, default) / set(key, value) / pop(key) will do (LRUCache by
+    default, or a client for a shared cache). Readers get a fresh
+    detached copy per call, read-only: setting its attributes or adding
+    it to a session raises SqlaException. Rows of registered classes are
+    evicted when a session flushes and again when it commits a change to
+    them; writes made with Core statements need an explicit evict() or
+    clear().
+    '''
+
+    def __init__(self, maxsize=4096, ttl=3600, backend=None):
+        self.backend = backend if backend is not None \
+            else LRUCache(maxsize, ttl)
+        self._keys = {}
+
+    def register(self, cls, unique_keys=()):
+        ''' Cache cls, looked up by primary key or any of unique_keys
+        (attribute name tuples).
+        '''
+        from sqlalchemy import inspect, event
+        props = inspect(cls).column_attrs
+        pk = tuple(prop.key for prop in props if prop.columns[0].primary_key)
+        self._keys[cls] = [pk] + [tuple(key) for key in unique_keys
+            if tuple(key) != pk]
+        for prop in props:
+            event.listen(getattr(cls, prop.key), 'set', self._refuse_set)
+
+    def _key(self, cls, names, values):
+        return 'entity:%s:%s:%r' % (cls.__name__, ','.join(names),
+            tuple(_normalize(value) for value in values))
+
+    def get(self, db, cls, pk):
+        ''' Detached copy of the cls row with primary key pk, or None. '''
+        names = self._keys[cls][0]
+        return self._get(db, cls, names, pk if isinstance(pk, tuple)
+            else (pk,))
+
+    def get_by(self, db, cls, **kw):
+        ''' Detached copy of the row matching a registered unique key. '''
+        names = tuple(sorted(kw))
+        for key in self._keys[cls]:
+            if tuple(sorted(key)) == names:
+                return self._get(db, cls, key, [kw[name] for name in key])
+        raise SqlaException('Unknow cache key %s of %s' % (names,
+            cls.__name__))
+
+    def _get(self, db, cls, names, values):
+        key = self._key(cls, names, values)
+        row = self.backend.get(key)
+        if row is not None and names != self._keys[cls][0]:
+            ''' a unique key maps to the primary key '''
+            pk = self._keys[cls][0]
+            row = self.backend.get(self._key(cls, pk, row))
+            if row is not None and any(
+                    _normalize(row[name]) != _normalize(value)
+                    for name, value in zip(names, values)):
+                row = None
+        if row is None:
+            row = self._load(db, cls, names, values)
+            if row is None:
+                return None
+            self._store(cls, row)
+        return self._copy(cls, row)
+
+    def _load(self, db, cls, names, values):
+        from sqlalchemy import inspect, select, and_
+        mapper = inspect(cls)
+        props = mapper.column_attrs
+        clause = and_(*[mapper.get_property(name).columns[0] == value
+            for name, value in zip(names, values)])
+        result = db.execute(select([prop.columns[0] for prop in props])\
+            .where(clause), mapper=mapper).first()
+        if result is None:
+            return None
+        return dict((prop.key, value) for prop, value in zip(props, result))
+
+    def _store(self, cls, row):
+        keys = self._keys[cls]
+        pk = [row[name] for name in keys[0]]
+        self.backend.set(self._key(cls, keys[0], pk), row)
+        for names in keys[1:]:
+            self.backend.set(self._key(cls, names,
+                [row[name] for name in names]), pk)
+
+    def _copy(self, cls, row):
+        from sqlalchemy import inspect
+        from sqlalchemy.orm import make_transient_to_detached
+        from sqlalchemy.orm.attributes import set_committed_value
+        obj = inspect(cls).class_manager.new_instance()
+        for name, value in row.iteritems():
+            set_committed_value(obj, name, value)
+        make_transient_to_detached(obj)
+        inspect(obj).info['entity_cache'] = True
+        return obj
+
+    def _refuse_set(self, target, value, oldvalue, initiator):
+        from sqlalchemy import inspect
+        if inspect(target).info.get('entity_cache'):
+            raise SqlaException('Read-only cached %s' % type(target).__name__)
+
+    def before_attach(self, session, instance):
+        ''' Session listener: copies stay out of sessions. '''
+        from sqlalchemy import inspect
+        if inspect(instance).info.get('entity_cache'):
+            raise SqlaException('Read-only cached %s' %
+                type(instance).__name__)
+
+    def _obj_keys(self, obj):
+        ''' Backend keys of obj under its current values and under the
+        ones unflushed or just flushed changes replaced.
+        '''
+        from sqlalchemy import inspect
+        state = inspect(obj)
+        keys = set()
+        for names in self._keys[type(obj)]:
+            values, old = [], []
+            for name in names:
+                history = state.attrs[name].history
+                values.append(state.dict.get(name))
+                old.append(history.deleted[0] if history.deleted
+                    else state.dict.get(name))
+            keys.add(self._key(type(obj), names, values))
+            keys.add(self._key(type(obj), names, old))
+        return keys
+
+    def evict(self, obj):
+        if type(obj) in self._keys:
+            for key in self._obj_keys(obj):
+                self.backend.pop(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def after_flush(self, session, flush_context):
+        ''' Evict now, and again on commit in case a reader cached the old
+        row in between; keys are taken now, commit expires the values.
+        '''
+        changed = session.info.setdefault('entity_cache', set())
+        for obj in session.new | session.dirty | session.deleted:
+            if type(obj) in self._keys:
+                keys = self._obj_keys(obj)
+                for key in keys:
+                    self.backend.pop(key)
+                changed.update(keys)
+
+    def after_commit(self, session):
+        for key in session.info.pop('entity_cache', ()):
+            self.backend.pop(key)
+
+    def after_rollback(self, session):
+        session.info.pop('entity_cache', None)
+
+''' GameTaxonomy, NewsCategory, SiteModel and SiteSeo, see orm.py '''
+entities = EntityCache()
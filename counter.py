@@ -0,0 +1,292 @@
+#!/usr/bin/python
+# coding: utf-8
+import time
+import atexit
+import logging
+import threading
+
+from sqlalchemy import case,\
+                       event
+from sqlalchemy.orm import Session
+
+from .schema import game_detail,\
+                    group_topic
+
+STAGED_KEY = 'counter_deltas'
+
+log = logging.getLogger(__name__)
+
+
+def delta_update(table, columns, floor=None):
+    ''' One UPDATE adding {column: {pk: delta}} to the rows, server side:
+    `column = column + CASE pk WHEN .. THEN delta .. ELSE 0 END`.
+    '''
+    pk = list(table.primary_key)[0]
+    values, pks = {}, set()
+    for column, deltas in columns.iteritems():
+        col = table.c[column]
+        delta = case(deltas.items(), value=pk, else_=0)
+        if floor is None:
+            values[column] = col + delta
+        else:
+            ''' col < floor - delta: no negative intermediate for UNSIGNED '''
+            values[column] = case([(col < floor - delta, floor)],
+                else_=col + delta)
+        pks.update(deltas)
+    return table.update().where(pk.in_(pks)).values(values)
+
+def _tables(items):
+    ''' [((table, column, pk), delta)] => {table: {column: {pk: delta}}} '''
+    tables = {}
+    for (table, column, pk), delta in items:
+        tables.setdefault(table, {}).setdefault(column, {})[pk] = delta
+    return tables
+
+def _engine(db, table):
+    bind = db.get_bind(clause=table) if hasattr(db, 'get_bind') else db
+    return getattr(bind, 'engine', bind)
+
+class CounterBuffer(object):
+    ''' Write-behind buffer of counter deltas keyed (table, pk, column).
+
+    `add` stages a delta on the session and only hands it to the buffer
+    when that session commits (it is dropped on rollback); `incr` buffers
+    it straight away, for counters such as page views that must not wait
+    for a commit. The buffer is flushed as one server-side
+    `column = column + CASE pk ... END` UPDATE per table once it holds
+    `max_pending` keys or `interval` seconds have passed, from the
+    `start()` thread if running, and synchronously at interpreter exit.
+
+    floor: lowest value a counter may reach, e.g. 0 for UNSIGNED columns;
+        None for no floor.
+    retries: flushes a failing delta is tried in before it is dropped
+    '''
+
+    def __init__(self, max_pending=500, interval=5.0, floor=None,
+            retries=3):
+        self.max_pending = max_pending
+        self.interval = interval
+        self.floor = floor
+        self.retries = retries
+        self._failures = {}
+        self._pending = {}
+        ''' deltas a flush took out of _pending and has not written yet '''
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._flushed = time.time()
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+        self._stopped = False
+        ''' called as listener(engine, {table: {column: {pk: delta}}})
+        after each written batch '''
+        self.listeners = []
+        atexit.register(self.stop)
+
+    def add(self, db, table, pk, column, delta=1):
+        ''' Stage `delta` on db; it is buffered when db commits. '''
+        staged = db.info.setdefault(STAGED_KEY, {})
+        key = (self, _engine(db, table), table, column, pk)
+        staged[key] = staged.get(key, 0) + delta
+
+    def incr(self, db, table, pk, column, delta=1):
+        ''' Buffer `delta` now, whatever happens to db's transaction. '''
+        self._merge({(_engine(db, table), table, column, pk): delta})
+
+    def pending(self, db, table, pk, column):
+        ''' Delta buffered for (table, pk, column) but not written yet,
+        including what a running flush has not committed.
+        '''
+        return self.pending_many(db, table, [pk], column)[pk]
+
+    def pending_many(self, db, table, pks, column):
+        ''' {pk: pending delta} for every pk in pks. '''
+        engine = _engine(db, table)
+        with self._lock:
+            return dict((pk, self._pending.get((engine, table, column, pk), 0)
+                + self._inflight.get((engine, table, column, pk), 0))
+                for pk in pks)
+
+    def _merge(self, deltas):
+        ''' Buffer deltas; a flush they call for runs on the start()
+        thread, never on the caller's.
+        '''
+        with self._lock:
+            for key, delta in deltas.iteritems():
+                self._pending[key] = self._pending.get(key, 0) + delta
+            size = len(self._pending)
+        self.start()
+        if size >= self.max_pending or \
+                time.time() - self._flushed >= self.interval:
+            self._wakeup.set()
+
+    def flush(self):
+        ''' Write every pending delta. A batch that fails is halved until
+        the failing deltas are found; those are kept for retry and dropped
+        after `retries` failed flushes, so one bad row cannot hold back the
+        others. Deltas are kept as they are while the database cannot be
+        reached. pending() counts a delta until its batch commits.
+        '''
+        batches = {}
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.time()
+            for key, delta in pending.iteritems():
+                if delta:
+                    engine, table, column, pk = key
+                    batches.setdefault(engine, []).append(
+                        ((table, column, pk), delta))
+                    self._inflight[key] = self._inflight.get(key, 0) + delta
+
+        for engine, items in batches.iteritems():
+            written, failed, kept = self._write(engine, items)
+            self._merge_back(engine, kept)
+            self._retry(engine, written, failed)
+            if not written:
+                continue
+            for listener in self.listeners:
+                try:
+                    listener(engine, _tables(written))
+                except Exception:
+                    log.exception('counter listener failed')
+
+    def _write(self, engine, items):
+        ''' Return the (written, failed, kept) items. '''
+        try:
+            conn = engine.connect()
+        except Exception:
+            log.exception('counter flush failed, deltas kept for retry')
+            return [], [], items
+        written, failed, batches = [], [], [items]
+        try:
+            while batches:
+                batch = batches.pop()
+                try:
+                    with conn.begin():
+                        for table, columns in _tables(batch).iteritems():
+                            conn.execute(delta_update(table, columns,
+                                self.floor))
+                except Exception, e:
+                    if getattr(e, 'connection_invalidated', False) or \
+                            conn.invalidated:
+                        log.exception('counter flush failed, deltas kept '
+                            'for retry')
+                        return written, failed, batch + [item for batch in batches
+                            for item in batch]
+                    if len(batch) > 1:
+                        half = len(batch) // 2
+                        batches.extend([batch[:half], batch[half:]])
+                    else:
+                        (table, column, pk), delta = batch[0]
+                        log.exception('counter %s.%s %+d of %s failed',
+                            table.name, column, delta, pk)
+                        failed.extend(batch)
+                else:
+                    written.extend(batch)
+                    with self._lock:
+                        self._settle(engine, batch)
+        finally:
+            conn.close()
+        return written, failed, []
+
+    def _settle(self, engine, items):
+        ''' Take items written or buffered again out of _inflight; called
+        with _lock held.
+        '''
+        for (table, column, pk), delta in items:
+            key = (engine, table, column, pk)
+            left = self._inflight.get(key, 0) - delta
+            if left:
+                self._inflight[key] = left
+            else:
+                self._inflight.pop(key, None)
+
+    def _merge_back(self, engine, items):
+        with self._lock:
+            self._settle(engine, items)
+            for (table, column, pk), delta in items:
+                key = (engine, table, column, pk)
+                self._pending[key] = self._pending.get(key, 0) + delta
+
+    def _retry(self, engine, written, failed):
+        ''' Keep failed deltas for retry, up to `retries` flushes. '''
+        with self._lock:
+            self._settle(engine, failed)
+            for (table, column, pk), delta in written:
+                self._failures.pop((engine, table, column, pk), None)
+            for (table, column, pk), delta in failed:
+                key = (engine, table, column, pk)
+                failures = self._failures.get(key, 0) + 1
+                if failures >= self.retries:
+                    self._failures.pop(key, None)
+                    log.error('dropped %s.%s %+d of %s after %d failures',
+                        table.name, column, delta, pk, failures)
+                else:
+                    self._failures[key] = failures
+                    self._pending[key] = self._pending.get(key, 0) + delta
+
+    def start(self):
+        ''' Flush every `interval` seconds, or when woken by _merge, from a
+        daemon thread; started again in a forked child.
+        '''
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def stop(self):
+        ''' Stop the thread and write what is left; run at exit. '''
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(self.interval)
+        self.flush()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception('counter flush failed, deltas kept for retry')
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    staged = session.info.pop(STAGED_KEY, None)
+    if not staged:
+        return
+    buffers = {}
+    for (buffer, engine, table, column, pk), delta in staged.iteritems():
+        buffers.setdefault(buffer, {})[(engine, table, column, pk)] = delta
+    for buffer, deltas in buffers.iteritems():
+        try:
+            buffer._merge(deltas)
+        except Exception:
+            log.exception('counter deltas lost')
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(STAGED_KEY, None)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    ''' Drop what a transaction staged and did not commit, e.g. when the
+    session is closed; after_commit has taken the rest already.
+    '''
+    if transaction.parent is None:
+        session.info.pop(STAGED_KEY, None)
+
+tag_references = CounterBuffer(floor=0)
+
+''' game_detail / group_topic hit counters '''
+hit_counters = CounterBuffer(max_pending=5000, interval=10.0, floor=0)
+
+HIT_COUNTERS = {
+    game_detail.name: ('count_visit', 'count_play', 'count_like',
+        'count_comment'),
+    group_topic.name: ('count_visit', 'count_reply'),
+}
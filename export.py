@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Streaming table export, CSV or JSON Lines.
+
+    python -m sqla.export user_event [-f jsonl] [-o out.jsonl] [-t iso]
+
+Rows are read as plain tuples in primary key order, one keyset chunk
+(`WHERE id > last ORDER BY id LIMIT n`) at a time, on a server-side
+cursor where the DBAPI has one, and written out as they arrive; memory
+stays bounded by the chunk size whatever the size of the table.
+"""
+import sys
+import csv
+import json
+import time
+import datetime
+from decimal import Decimal
+from optparse import OptionParser
+
+from sqlalchemy import select
+
+from .base import SqlaException
+from .schema import metadata
+
+''' int columns holding a unix timestamp '''
+TIMESTAMPS = ('_created', '_modified')
+
+
+def get_table(name):
+    table = metadata.tables.get(name)
+    if table is None:
+        raise SqlaException('Unknow table %s' % name)
+    return table
+
+def iter_rows(bind, table, columns=None, chunk=5000, after=None):
+    ''' Yield the rows of a table as tuples, in primary key order.
+
+    columns: names to export, all columns by default
+    after: resume after this primary key value
+    '''
+    pk = list(table.primary_key.columns)
+    if len(pk) != 1:
+        raise SqlaException('Unknow primary key of %s' % table.name)
+    pk = pk[0]
+    cols = [table.c[name] for name in columns] if columns else list(table.c)
+    if pk not in cols:
+        ''' the keyset needs the pk; it is cut from each row again '''
+        cols, strip = cols + [pk], True
+    else:
+        strip = False
+    key = cols.index(pk)
+
+    last = after
+    conn = bind.connect()
+    try:
+        while True:
+            query = select(cols).order_by(pk).limit(chunk)
+            if last is not None:
+                query = query.where(pk > last)
+            result = conn.execution_options(stream_results=True)\
+                .execute(query)
+            count = 0
+            for row in result:
+                row = tuple(row)
+                last = row[key]
+                count += 1
+                yield row[:-1] if strip else row
+            result.close()
+            if count < chunk:
+                break
+    finally:
+        conn.close()
+
+def convert_timestamps(rows, header, fmt='iso'):
+    ''' Turn the TIMESTAMPS columns into UTC datetimes ('datetime') or
+    ISO 8601 strings ('iso').
+    '''
+    indexes = [i for i, name in enumerate(header) if name in TIMESTAMPS]
+    for row in rows:
+        if indexes:
+            row = list(row)
+            for i in indexes:
+                if row[i] is not None:
+                    value = datetime.datetime.utcfromtimestamp(row[i])
+                    row[i] = value.isoformat() if fmt == 'iso' else value
+            row = tuple(row)
+        yield row
+
+def _plain(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(repr(value))
+
+def write_csv(rows, header, out):
+    writer = csv.writer(out)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([value.encode('utf-8') if isinstance(value, unicode)\
+            else value for value in row])
+        yield row
+
+def write_jsonl(rows, header, out):
+    for row in rows:
+        out.write(json.dumps(dict(zip(header, row)), default=_plain))
+        out.write('\n')
+        yield row
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+}
+
+def export(bind, table_name, out, format='csv', columns=None, chunk=5000,
+        timestamps=None, after=None, progress=None, every=10000):
+    ''' Stream a table to the file object `out`; return the row count.
+
+    timestamps: None keeps the ints, or 'iso' / 'datetime'
+    progress: called as progress(count) every `every` rows and at the end
+    '''
+    writer = WRITERS.get(format)
+    if writer is None:
+        raise SqlaException('Unknow export format %s' % format)
+    table = get_table(table_name)
+    header = list(columns) if columns else [c.name for c in table.c]
+
+    rows = iter_rows(bind, table, columns, chunk, after)
+    if timestamps:
+        rows = convert_timestamps(rows, header, timestamps)
+    count = 0
+    for row in writer(rows, header, out):
+        count += 1
+        if progress and count % every == 0:
+            progress(count)
+    if progress:
+        progress(count)
+    return count
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] table')
+    parser.add_option('-f', dest='format', default='csv',
+        help='csv or jsonl [%default]')
+    parser.add_option('-o', dest='output', help='output file [stdout]')
+    parser.add_option('-c', dest='columns', help='comma separated columns')
+    parser.add_option('-n', dest='chunk', type='int', default=5000,
+        help='rows per query [%default]')
+    parser.add_option('-t', dest='timestamps',
+        help='convert _created/_modified: iso')
+    parser.add_option('-a', dest='after', type='int',
+        help='resume after this id')
+    parser.add_option('-q', dest='quiet', action='store_true')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('one table name is required')
+
+    from . import engine
+
+    start = time.time()
+    def progress(count):
+        elapsed = time.time() - start
+        sys.stderr.write('\r%s: %d rows, %.1fs, %d rows/s' % (args[0],
+            count, elapsed, count / elapsed if elapsed else 0))
+        sys.stderr.flush()
+
+    out = open(opts.output, 'wb') if opts.output else sys.stdout
+    try:
+        export(engine, args[0], out, opts.format,
+            opts.columns and opts.columns.split(','), opts.chunk,
+            opts.timestamps, opts.after, None if opts.quiet else progress)
+    finally:
+        if opts.output:
+            out.close()
+    if not opts.quiet:
+        sys.stderr.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Follow graph over user_relation.
+
+A follow of B by A is two rows: (A, B, reverse=0) and (B, A, reverse=1),
+so both directions are a prefix of the (user_id, target_id, reverse)
+unique key. Every bulk check below is one query on that index, or none
+when the user's adjacency is cached.
+"""
+import bisect
+from array import array
+
+from sqlalchemy import select,\
+                       func,\
+                       and_,\
+                       inspect
+from sqlalchemy.orm import object_session
+
+from .cache import LRUCache,\
+                   CommitEviction
+from .schema import user_relation
+
+FOLLOW_KEY = 'follow_graph'
+
+''' cached for users with more than max_edges relations '''
+TOO_MANY = False
+
+
+def _contains(ids, id):
+    i = bisect.bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+class FollowGraph(object):
+    ''' Bulk follow checks, with an optional adjacency cache.
+
+    cache: uid => (following, followers), sorted array('I') of user ids,
+        or TOO_MANY; None to always query
+    max_edges: users with more relations than this are not cached; they
+        are marked TOO_MANY, so their checks go straight to the IN query
+    '''
+
+    def __init__(self, cache=None, max_edges=5000):
+        self.cache = cache
+        self.max_edges = max_edges
+        self._eviction = CommitEviction(cache, FOLLOW_KEY)\
+            if cache is not None else None
+
+    def adjacency(self, db, uid):
+        ''' (following, followers) of uid, from the cache when it has them;
+        None when uid has more than max_edges relations.
+        '''
+        if self.cache is not None:
+            cached = self.cache.get(uid)
+            if cached is TOO_MANY:
+                return None
+            if cached is not None:
+                return cached
+        ur = user_relation.c
+        rows = db.execute(select([ur.target_id, ur.reverse])\
+            .where(ur.user_id == uid).limit(self.max_edges + 1)).fetchall()
+        if len(rows) > self.max_edges:
+            if self.cache is not None:
+                self.cache.set(uid, TOO_MANY)
+            return None
+        following = array('I', sorted(t for t, reverse in rows if not reverse))
+        followers = array('I', sorted(t for t, reverse in rows if reverse))
+        if self.cache is not None:
+            self.cache.set(uid, (following, followers))
+        return following, followers
+
+    def relations_many(self, db, uid, ids):
+        ''' {id: (uid follows id, id follows uid)} in one query. '''
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        if self.cache is not None:
+            adjacency = self.adjacency(db, uid)
+            if adjacency is not None:
+                following, followers = adjacency
+                return dict((id, (_contains(following, id),
+                    _contains(followers, id))) for id in ids)
+
+        ur = user_relation.c
+        relations = dict((id, [False, False]) for id in ids)
+        for target_id, reverse in db.execute(select([ur.target_id,
+                ur.reverse]).where(and_(ur.user_id == uid,
+                ur.target_id.in_(ids)))):
+            relations[target_id][1 if reverse else 0] = True
+        return dict((id, tuple(r)) for id, r in relations.iteritems())
+
+    def following_many(self, db, uid, ids):
+        ''' The ids uid follows. '''
+        return set(id for id, (following, followed) in
+            self.relations_many(db, uid, ids).iteritems() if following)
+
+    def followed_many(self, db, uid, ids):
+        ''' The ids following uid. '''
+        return set(id for id, (following, followed) in
+            self.relations_many(db, uid, ids).iteritems() if followed)
+
+    def mutual_many(self, db, uid, ids):
+        return set(id for id, (following, followed) in
+            self.relations_many(db, uid, ids).iteritems()
+            if following and followed)
+
+    def followers_count_many(self, db, ids):
+        ''' {id: followers} in one GROUP BY over the index prefix. '''
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        ur = user_relation.c
+        counts = dict.fromkeys(ids, 0)
+        counts.update(db.execute(select([ur.user_id, func.count()])\
+            .where(and_(ur.user_id.in_(ids), ur.reverse == 1))\
+            .group_by(ur.user_id)).fetchall())
+        return counts
+
+    def forget(self, db, *uids):
+        ''' Evict now and again when db commits. '''
+        if self._eviction is not None:
+            self._eviction.forget(db, *uids)
+
+    def on_change(self, mapper, connection, target):
+        ''' UserRelation mapper events '''
+        if self._eviction is None:
+            return
+        state = inspect(target)
+        uids = set([target.user_id, target.target_id])
+        for name in ('user_id', 'target_id'):
+            uids.update(state.attrs[name].history.deleted)
+        self._eviction.forget(object_session(target), *uids)
+
+follow_graph = FollowGraph(LRUCache(maxsize=20000, ttl=600))
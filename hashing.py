@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Password hashing across processes.
+
+hash_password is pure CPU; a pool of processes hashes in parallel where
+threads would queue on the GIL, and a request thread waiting on the pool
+leaves the GIL to the others.
+
+The pool is forked, and a child forked while other threads run can block
+forever on a lock one of them held (Python 2 has no spawn or forkserver
+pools), so start() the executor at process start, before any thread.
+"""
+import os
+import hmac
+import logging
+import threading
+import multiprocessing
+
+log = logging.getLogger(__name__)
+
+
+def _hash(item):
+    ''' Runs in the pool; module level so it can be pickled. '''
+    from core.hash import hash_password
+    from core.common import ascii_convert_unicode as _u
+    password, secret = item
+    return hash_password(_u(password), secret)
+
+class _Done(object):
+    ''' AsyncResult of a hash computed inline. '''
+
+    def __init__(self, item, callback=None):
+        try:
+            self._value, self._success = _hash(item), True
+        except Exception, e:
+            self._value, self._success = e, False
+        if self._success and callback:
+            callback(self._value)
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self._success
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if not self._success:
+            raise self._value
+        return self._value
+
+class HashExecutor(object):
+    ''' A process pool for hash_password, sized to the cores unless told
+    otherwise.
+
+    Call start() at process start, and again in each forked worker
+    before it starts threads. Otherwise the pool is created on first use
+    only while no other thread runs; until then hashing stays inline on
+    the calling thread, with a warning.
+
+    submit() returns an AsyncResult, a future: ready(), wait(),
+    get(timeout); hash() and verify() block the calling thread only.
+    '''
+
+    def __init__(self, processes=None, timeout=None):
+        self.processes = processes
+        self.timeout = timeout
+        self._pool = None
+        self._pid = None
+        self._warned = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        ''' Fork the workers now, while this is the only thread. '''
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = multiprocessing.Pool(
+                    self.processes or multiprocessing.cpu_count())
+                self._pid = os.getpid()
+        return self
+
+    @property
+    def pool(self):
+        ''' None while the pool is not started and other threads run. '''
+        if self._pid != os.getpid():
+            if threading.active_count() > 1:
+                if self._warned != os.getpid():
+                    self._warned = os.getpid()
+                    log.warning('HashExecutor not started before threads, '
+                        'hashing inline')
+                return None
+            self.start()
+        return self._pool
+
+    def submit(self, password, secret, callback=None):
+        pool = self.pool
+        if pool is None:
+            return _Done((password, secret), callback)
+        return pool.apply_async(_hash, ((password, secret),),
+            callback=callback)
+
+    def hash(self, password, secret):
+        ''' get() with a timeout, so a signal can still interrupt the wait '''
+        return self.submit(password, secret).get(self.timeout or 1e9)
+
+    def verify(self, password, secret, hashed):
+        return _compare(self.hash(password, secret), hashed)
+
+    def map(self, items, chunksize=64):
+        ''' [hash] of [(password, secret)] '''
+        pool = self.pool
+        if pool is None:
+            return map(_hash, items)
+        return pool.map(_hash, list(items), chunksize)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.close()
+                self._pool.join()
+            self._pool = self._pid = None
+
+def _compare(a, b):
+    if not isinstance(a, str) or not isinstance(b, str):
+        a, b = unicode(a).encode('utf-8'), unicode(b or '').encode('utf-8')
+    return hmac.compare_digest(a, b)
+
+def hash_password(password, secret, executor=None):
+    ''' Inline without an executor. '''
+    if executor is None:
+        return _hash((password, secret))
+    return executor.hash(password, secret)
+
+def verify_password(password, secret, hashed, executor=None):
+    ''' Constant time comparison of hash_password(password, secret). '''
+    if executor is None:
+        return _compare(_hash((password, secret)), hashed)
+    return executor.verify(password, secret, hashed)
+
+def hash_passwords(items, executor=None):
+    ''' [hash_password(password, secret)] of [(password, secret)]. '''
+    items = list(items)
+    if executor is None or len(items) < 2:
+        return map(_hash, items)
+    return executor.map(items)
+
+''' shared by request threads; start() it before the server starts any '''
+executor = HashExecutor()
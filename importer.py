@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Bulk user import.
+
+Each chunk of (email, username, password, ip) costs one duplicate
+check per unique column, a parallel hashing pass, one executemany into
+user_base, one SELECT of the generated ids and one executemany into
+user_profile, all in a single transaction.
+"""
+import time
+import socket
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from .schema import user_base,\
+                    user_profile
+from .hashing import hash_passwords,\
+                     HashExecutor
+
+
+class ImportResult(object):
+    ''' ids: {email: user id} of the imported users
+    rejected: [(row, reason)], reason is 'duplicate email',
+        'duplicate username', 'duplicate' (lost a race) or 'invalid'
+    '''
+
+    def __init__(self):
+        self.ids = {}
+        self.rejected = []
+        self.elapsed = 0.0
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    @property
+    def rate(self):
+        ''' imported users per second '''
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _existing(conn, column, values):
+    ''' Lower-cased values already stored, whatever the collation. '''
+    if not values:
+        return set()
+    return set(v.lower() for v, in conn.execute(
+        select([column]).where(column.in_(values))))
+
+def _user_row(email, username, ip):
+    from core.func import ip2num
+    from core.hash import random_string, random_token
+    return dict(email=email, username=username, secret=random_string(),
+        login_sequence=random_token(), active_token=random_token(),
+        _login_addr=ip2num(ip))
+
+def _insert(conn, rows):
+    ''' Insert user_base and user_profile rows; return {email: id}. '''
+    conn.execute(user_base.insert(), rows)
+    ids = dict(conn.execute(select([user_base.c.email, user_base.c.id])\
+        .where(user_base.c.email.in_([row['email'] for row in rows])))\
+        .fetchall())
+    conn.execute(user_profile.insert(),
+        [dict(user_id=ids[row['email']]) for row in rows])
+    return ids
+
+def import_users(bind, users, chunk=1000, processes=None, progress=None):
+    ''' Create users and their profiles from (email, username, password, ip).
+
+    Duplicates, within the import or against the table, are rejected row
+    by row and the rest of the chunk goes on; a chunk that still hits a
+    unique key (a concurrent writer) is retried one row at a time.
+    processes: hashing workers, one per core by default, 1 hashes inline
+    progress: called as progress(result) after each chunk
+    '''
+    result = ImportResult()
+    seen_emails, seen_names = set(), set()
+    executor = None if processes == 1 else HashExecutor(processes)
+    start = time.time()
+    conn = bind.connect()
+    try:
+        for users_chunk in _chunks(users, chunk):
+            taken_emails = _existing(conn, user_base.c.email,
+                [u[0] for u in users_chunk if u and u[0]])
+            taken_names = _existing(conn, user_base.c.username,
+                [u[1] for u in users_chunk if len(u) > 1 and u[1]])
+
+            accepted, rows = [], []
+            for user in users_chunk:
+                try:
+                    email, username, password, ip = user
+                    email_key, name_key = email.lower(), username.lower()
+                    row = _user_row(email, username, ip)
+                except (ValueError, TypeError, AttributeError, socket.error):
+                    result.rejected.append((user, 'invalid'))
+                    continue
+                if email_key in taken_emails or email_key in seen_emails:
+                    result.rejected.append((user, 'duplicate email'))
+                elif name_key in taken_names or name_key in seen_names:
+                    result.rejected.append((user, 'duplicate username'))
+                else:
+                    seen_emails.add(email_key)
+                    seen_names.add(name_key)
+                    accepted.append(user)
+                    rows.append(row)
+            if not rows:
+                continue
+
+            hashes = hash_passwords(((user[2], row['secret'])
+                for user, row in zip(accepted, rows)), executor)
+            for row, hashed in zip(rows, hashes):
+                row['password'] = hashed
+
+            trans = conn.begin()
+            try:
+                result.ids.update(_insert(conn, rows))
+                trans.commit()
+            except IntegrityError:
+                trans.rollback()
+                for user, row in zip(accepted, rows):
+                    trans = conn.begin()
+                    try:
+                        result.ids.update(_insert(conn, [row]))
+                        trans.commit()
+                    except IntegrityError:
+                        trans.rollback()
+                        result.rejected.append((user, 'duplicate'))
+
+            result.elapsed = time.time() - start
+            if progress:
+                progress(result)
+    finally:
+        conn.close()
+        if executor is not None:
+            executor.shutdown()
+    result.elapsed = time.time() - start
+    return result
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Top-K game leaderboards kept in memory.
+
+A board ranks games by one metric ('play', 'like', 'score') overall or
+within a genre (game_genre) or platform (game_platform). Boards are
+built in one pass over game_detail, saved to and loaded from the
+game_leaderboard snapshot, and kept current from hit counter flushes
+and score rollups: the changed games are queued and read again, by
+primary key, on a daemon thread, never on the committing one. page()
+never touches the database.
+"""
+import bisect
+import logging
+import threading
+from decimal import Decimal
+
+from sqlalchemy import select
+
+from .base import SqlaException
+from .schema import game_detail,\
+                    game_genre,\
+                    game_platform,\
+                    game_leaderboard
+from .counter import hit_counters
+from . import rollup
+
+log = logging.getLogger(__name__)
+
+_columns = ('count_play', 'count_like', 'total_score', 'count_score')
+
+
+class TopK(object):
+    ''' The k best (value, id) of a board, highest first.
+
+    Up to k + slack entries are kept so members that fall back are still
+    known. `complete` means every eligible game is in the board; a board
+    that is neither complete nor holding k entries is stale.
+    '''
+
+    def __init__(self, k, slack, complete=False):
+        self.k = k
+        self.size = k + slack
+        self.complete = complete
+        self._entries = []
+        self._values = {}
+
+    def update(self, id, value):
+        ''' value None takes the game off the board. '''
+        old = self._values.pop(id, None)
+        if old is not None:
+            del self._entries[bisect.bisect_left(self._entries, (-old, id))]
+        if value is None:
+            return
+        entry = (-value, id)
+        if self._entries and entry > self._entries[-1] and \
+                (len(self._entries) >= self.size or not self.complete):
+            ''' behind the tail, where games we do not keep may rank '''
+            self.complete = False
+            return
+        bisect.insort(self._entries, entry)
+        self._values[id] = value
+        if len(self._entries) > self.size:
+            value, id = self._entries.pop()
+            del self._values[id]
+            self.complete = False
+
+    @property
+    def stale(self):
+        return not self.complete and len(self._entries) < self.k
+
+    def page(self, start, stop):
+        ''' [(rank, game id, value)], ranks from 1, never past k. '''
+        stop = min(stop, self.k)
+        return [(rank + 1, id, -value) for rank, (value, id) in
+            enumerate(self._entries[start:stop], start)]
+
+    def items(self):
+        ''' [(rank, game id, value)] of every entry kept, slack included '''
+        return [(rank + 1, id, -value) for rank, (value, id) in
+            enumerate(self._entries)]
+
+    def __contains__(self, id):
+        return id in self._values
+
+    def __len__(self):
+        return min(len(self._entries), self.k)
+
+class Leaderboards(object):
+    ''' Every board, keyed (metric, scope, scope_id).
+
+    k: ranks served per board
+    min_votes: count_score a game needs before it is ranked by score
+    interval: seconds between refreshes of the touched games when no
+        listener wakes the thread
+    '''
+
+    def __init__(self, k=100, slack=None, min_votes=5, interval=5.0):
+        self.k = k
+        self.slack = k if slack is None else slack
+        self.min_votes = min_votes
+        self.metrics = {
+            'play': lambda row: row['count_play'],
+            'like': lambda row: row['count_like'],
+            'score': self._score,
+        }
+        self._boards = {}
+        self._touched = set()
+        self._lock = threading.RLock()
+        self._attached = False
+        self.interval = interval
+        self._bind = None
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _score(self, row):
+        if row['count_score'] < max(self.min_votes, 1):
+            return None
+        return float(row['total_score']) / row['count_score']
+
+    def _board(self, boards, metric, scope, scope_id, complete):
+        key = (metric, scope, scope_id)
+        board = boards.get(key)
+        if board is None:
+            board = boards[key] = TopK(self.k, self.slack, complete)
+        return board
+
+    def _memberships(self, conn, ids=None):
+        ''' {game id: [(scope, scope_id)]}, for every game without ids. '''
+        scopes = {}
+        for scope, table, column in (
+                ('genre', game_genre, game_genre.c.genre_id),
+                ('platform', game_platform, game_platform.c.platform_id)):
+            query = select([table.c.game_id, column])
+            if ids is not None:
+                query = query.where(table.c.game_id.in_(ids))
+            for game_id, scope_id in conn.execute(query):
+                scopes.setdefault(game_id, []).append((scope, scope_id))
+        return scopes
+
+    def _rank(self, boards, row, scopes, complete):
+        for metric, value in self.metrics.iteritems():
+            value = value(row)
+            for scope, scope_id in [('all', 0)] + scopes:
+                self._board(boards, metric, scope, scope_id, complete)\
+                    .update(row['id'], value)
+
+    def build(self, bind):
+        ''' Rank every game: one pass over game_detail, one over each
+        membership table.
+        '''
+        conn = bind.connect()
+        try:
+            memberships = self._memberships(conn)
+            boards = {}
+            result = conn.execution_options(stream_results=True).execute(
+                select([game_detail.c.id] +
+                    [game_detail.c[name] for name in _columns]))
+            for row in result:
+                self._rank(boards, row, memberships.get(row['id'], []), True)
+        finally:
+            conn.close()
+        with self._lock:
+            self._boards = boards
+            self._touched.clear()
+        return self
+
+    def save(self, bind):
+        ''' Replace the game_leaderboard snapshot with the boards. '''
+        with self._lock:
+            rows = [dict(metric=metric, scope=scope, scope_id=scope_id,
+                rank=rank, game_id=id, value=Decimal('%.4f' % value),
+                complete=board.complete)
+                for (metric, scope, scope_id), board in
+                    self._boards.iteritems()
+                for rank, id, value in board.items()]
+        with bind.connect() as conn:
+            with conn.begin():
+                conn.execute(game_leaderboard.delete())
+                if rows:
+                    conn.execute(game_leaderboard.insert(), rows)
+        return len(rows)
+
+    def load(self, bind):
+        ''' Boards from the snapshot; built from game_detail (and saved)
+        when there is none.
+        '''
+        gl = game_leaderboard.c
+        boards, complete = {}, {}
+        with bind.connect() as conn:
+            for row in conn.execute(select([gl.metric, gl.scope, gl.scope_id,
+                    gl.game_id, gl.value, gl.complete])):
+                key = (row.metric, row.scope, row.scope_id)
+                self._board(boards, row.metric, row.scope, row.scope_id,
+                    True).update(row.game_id, float(row.value))
+                complete[key] = bool(row.complete)
+        if not boards:
+            self.build(bind)
+            self.save(bind)
+            return self
+        for key, board in boards.iteritems():
+            board.complete = complete[key]
+        with self._lock:
+            self._boards = boards
+        return self
+
+    def touch(self, ids):
+        with self._lock:
+            self._touched.update(ids)
+
+    def refresh(self, bind, chunk=500):
+        ''' Re-rank the touched games, read by primary key; rebuild when a
+        board went stale.
+        '''
+        with self._lock:
+            touched, self._touched = list(self._touched), set()
+        if not touched:
+            return
+        conn = bind.connect()
+        try:
+            rows, memberships = [], {}
+            for start in range(0, len(touched), chunk):
+                ids = touched[start:start + chunk]
+                rows.extend(conn.execute(select([game_detail.c.id] +
+                    [game_detail.c[name] for name in _columns])\
+                    .where(game_detail.c.id.in_(ids))).fetchall())
+                memberships.update(self._memberships(conn, ids))
+        finally:
+            conn.close()
+
+        with self._lock:
+            found = set()
+            for row in rows:
+                scopes = memberships.get(row['id'], [])
+                found.add(row['id'])
+                for key, board in self._boards.iteritems():
+                    if key[1] != 'all' and key[1:] not in scopes and \
+                            row['id'] in board:
+                        board.update(row['id'], None)
+                self._rank(self._boards, row, scopes, False)
+            for id in set(touched) - found:
+                for board in self._boards.itervalues():
+                    board.update(id, None)
+            stale = any(board.stale for board in self._boards.itervalues())
+        if stale:
+            self.build(bind)
+
+    def page(self, metric, genre=None, platform=None, start=0, limit=20):
+        ''' [(rank, game id, value)] of one board. '''
+        if metric not in self.metrics:
+            raise SqlaException('Unknow leaderboard metric %s' % metric)
+        if genre is not None:
+            key = (metric, 'genre', genre)
+        elif platform is not None:
+            key = (metric, 'platform', platform)
+        else:
+            key = (metric, 'all', 0)
+        with self._lock:
+            board = self._boards.get(key)
+            return board.page(start, start + limit) if board else []
+
+    def on_counters(self, engine, tables):
+        ''' hit_counters listener: queue the games for the thread '''
+        columns = tables.get(game_detail, {})
+        ids = set()
+        for column in ('count_play', 'count_like'):
+            ids.update(columns.get(column, ()))
+        if ids:
+            self.touch(ids)
+            self._wake()
+
+    def on_rollup(self, session, ids):
+        ''' rollup listener, after the commit of changed scores; queues
+        the games for the thread, as a rebuild must not run in a commit.
+        '''
+        self.touch(ids)
+        self._wake()
+
+    def attach(self, bind):
+        ''' Load the boards, follow counter flushes and commits, and start
+        the thread that refreshes the boards from bind.
+        '''
+        self.load(bind)
+        with self._lock:
+            self._bind = bind
+            if self._attached:
+                return self
+            self._attached = True
+        hit_counters.listeners.append(self.on_counters)
+        rollup.listeners.append(self.on_rollup)
+        self.start()
+        return self
+
+    def _wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        ''' Refresh the touched games every `interval` seconds, or when a
+        listener wakes it, from a daemon thread; started again in a
+        forked child.
+        '''
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._bind is None:
+                continue
+            try:
+                self.refresh(self._bind)
+            except Exception:
+                log.exception('leaderboard refresh failed')
+
+leaderboards = Leaderboards()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# coding: utf-8
+""" UserEvent message encoding and rendering.
+
+A message is a Mako template source plus its params, stored as JSON:
+    ["<source>", {"key": "value"}]
+Rows written before the JSON encoding hold repr((source, params)); they
+are still read, through ast.literal_eval rather than eval.
+"""
+import ast
+import json
+import threading
+from collections import OrderedDict
+
+
+def encode_message(msg, params):
+    return json.dumps([msg, params])
+
+def decode_message(message):
+    ''' Return (source, params) or None for an unreadable message. '''
+    try:
+        if message.startswith('['):
+            msg, params = json.loads(message)
+        else:
+            msg, params = ast.literal_eval(message)
+    except (AttributeError, TypeError, ValueError, SyntaxError):
+        return None
+    if isinstance(msg, basestring) and isinstance(params, dict):
+        return msg, params
+    return None
+
+class TemplateCache(object):
+    ''' Bounded LRU of compiled Mako templates keyed by source. '''
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.compiled = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, source):
+        with self._lock:
+            template = self._templates.pop(source, None)
+            if template is not None:
+                self._templates[source] = template
+                return template
+
+        from mako.template import Template
+        template = Template(source)
+        with self._lock:
+            self.compiled += 1
+            self._templates[source] = template
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+templates = TemplateCache()
+
+def render_message(message, cache=templates):
+    decoded = decode_message(message)
+    if decoded is None:
+        return None
+    msg, params = decoded
+    try:
+        return cache.get(msg).render(**params)
+    except Exception:
+        return None
+
+def render_events(events, cache=templates):
+    ''' Render the messages of a whole feed; each distinct source is
+    compiled at most once, even when the feed outgrows the cache.
+    '''
+    decoded = [decode_message(event.message) for event in events]
+    compiled = {}
+    rendered = []
+    for item in decoded:
+        if item is None:
+            rendered.append(None)
+            continue
+        msg, params = item
+        if msg not in compiled:
+            try:
+                compiled[msg] = cache.get(msg)
+            except Exception:
+                compiled[msg] = None
+        try:
+            rendered.append(compiled[msg].render(**params))
+        except Exception:
+            rendered.append(None)
+    return rendered
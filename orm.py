@@ -1,25 +1,68 @@
 #!/usr/bin/python
 # coding: utf-8
+import threading
+
 from sqlalchemy import or_,\
                        and_,\
-                       select
-from sqlalchemy.orm import mapper,\
+                       func,\
+                       select,\
+                       event,\
+                       inspect,\
+                       tuple_
+from sqlalchemy.orm import Session,\
+                           mapper,\
                            relationship,\
                            object_session,\
                            deferred,\
-                           outerjoin
+                           outerjoin,\
+                           column_property,\
+                           selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.hybrid import hybrid_property
-from mako.template import Template
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
 
 from .schema import *
-from core.common import ascii_convert_unicode as _u
+from .base import SqlaException
+from .registry import object_types
+from .cache import LRUCache,\
+                    CommitEviction,\
+                    entities
+from .pagination import keyset_page,\
+                         keyset_page_by
+from .message import encode_message,\
+                     render_message,\
+                     render_events
+from .counter import tag_references,\
+                     hit_counters,\
+                     HIT_COUNTERS
+from .hashing import hash_password,\
+                     verify_password
+from .follow import follow_graph
+from . import rollup
 from core.func import int2datetime, datetime2int, ip2num, num2ip
-from core.hash import random_string, random_token, hash_password
 
 
+class _ModelType(type):
+    ''' Maps every model on the first lookup of a class attribute the
+    mappers add, e.g. GameDetail.genre_id before any session exists.
+    '''
+
+    def __getattr__(cls, name):
+        if _mapped or name.startswith('__') or \
+                _mapping is threading.current_thread():
+            raise AttributeError(name)
+        setup_mappers()
+        return getattr(cls, name)
+
 class BaseModel(object):
+    __metaclass__ = _ModelType
     _object_type_id     = None
 
+    def __new__(cls, *a, **kw):
+        _mapped or setup_mappers()
+        return super(BaseModel, cls).__new__(cls)
+
     def __init__(self, *a, **kw):
         [hasattr(self, k) and setattr(self, k, v) for k, v in kw.iteritems()]
 
@@ -42,13 +85,8 @@ class BaseModel(object):
     @hybrid_property
     def object_type_id(self):
         if self._object_type_id is None:
-            app_label, model = self.__table_name__.split('_', 1)
-            obj = object_session(self).query(SiteModel)\
-                .filter(and_(
-                    SiteModel.app_label     == app_label,
-                    SiteModel.model         == model,
-                )).first()
-            self._object_type_id = obj.id if obj else None
+            self._object_type_id = object_types.get_table_id(
+                object_session(self), self.__table_name__)
         return self._object_type_id
 
     def update_by_form(self, formobj, deny=[]):
@@ -58,8 +96,53 @@ class BaseModel(object):
             list(set(formobj.data.keys()).difference(deny)),
         )
 
+class AbstractGenericModel(object):
+    ''' Rows pointing at any model through (object_type_id, object_pk). '''
+    _target_loaded  = False
+    _target         = None
+
+    @property
+    def target(self):
+        ''' The object this row points at; see prefetch_targets. '''
+        if not self._target_loaded:
+            prefetch_targets(object_session(self), [self])
+        return self._target
+
+class AbstractCommentModel(object):
+    ''' site_comment rows of an object; prefetch_comments fills
+    _prefetched_comments = (newest first, per_object) for a whole page.
+    '''
+    _prefetched_comments = None
+
+    def _comments(self):
+        return object_session(self).query(SiteComment)\
+            .filter(and_(
+                SiteComment.object_type_id  == self.object_type_id,
+                SiteComment.object_pk       == self.id,
+                SiteComment.hide            == 0,
+            ))
+
+    def get_comments(self, start=0, offset=10):
+        if self._prefetched_comments is not None:
+            comments, per_object = self._prefetched_comments
+            if offset <= per_object or len(comments) < per_object:
+                return comments[start:offset]
+        return self._comments()\
+            .order_by(SiteComment._created.desc(), SiteComment.id.desc())\
+            [start:offset]
+
+    def comments_page(self, cursor=None, limit=10):
+        ''' Keyset page of visible comments, newest first. '''
+        return keyset_page(self._comments(), SiteComment._created,
+            SiteComment.id, cursor, limit)
+
 class AbstractTagModel(object):
+    ''' prefetch_tags fills _prefetched_tags = {uid: [(TagMark, TagContent)]} '''
+    _prefetched_tags = None
+
     def get_user_tags(self, uid, quantity=10):
+        if self._prefetched_tags and uid in self._prefetched_tags:
+            return self._prefetched_tags[uid][0:quantity]
         return object_session(self).query(TagMark, TagContent)\
             .select_from(
                 outerjoin(TagMark, TagContent, TagMark.tag_id==TagContent.id),
@@ -69,41 +152,65 @@ class AbstractTagModel(object):
                 TagMark.user_id             == uid,
             ))[0:quantity]
 
-    def update_user_tags(self, uid, tags=[], quantity=10):
-        old_tags = map(
-            lambda obj: obj[1].content,
-            self.get_user_tags(uid, quantity=quantity),
-        )
+    def update_user_tags(self, uid, tags=[]):
+        ''' Sync the user's tags on this object to `tags` with a constant
+        number of statements, whatever the number of tags. Every mark of
+        the user is synced; the `quantity` argument, which compared
+        `tags` with the first `quantity` marks only, is gone.
+        '''
+        db = object_session(self)
+        object_type_id = self.object_type_id
+        tags = set(normalize_tag(tag) for tag in tags)
+        if self._prefetched_tags:
+            self._prefetched_tags.pop(uid, None)
+        marks = db.execute(
+            select([tag_mark.c.id, tag_mark.c.tag_id, tag_content.c.content])\
+            .select_from(tag_mark.join(tag_content,
+                tag_mark.c.tag_id==tag_content.c.id))\
+            .where(and_(
+                tag_mark.c.object_type_id   == object_type_id,
+                tag_mark.c.object_pk        == self.id,
+                tag_mark.c.user_id          == uid,
+            ))).fetchall()
+        old_tags = dict((content, (id, tag_id)) for id, tag_id, content in marks)
 
         removes = list(set(old_tags).difference(tags))
         adds    = list(set(tags).difference(old_tags))
 
+        remove_ids  = [old_tags[tag][1] for tag in removes]
+        add_ids     = resolve_tags(db, adds).values() if adds else []
+
         ''' remove tags '''
         if removes:
-            remove_tags = object_session(self).query(TagMark, TagContent)\
-                .select_from(
-                    outerjoin(TagMark, TagContent, TagMark.tag_id==TagContent.id),
-                ).filter(and_(
-                    TagMark.object_type_id  == self.object_type_id,
-                    TagMark.object_pk       == self.id,
-                    TagMark.user_id         == uid,
-                    TagContent.content.in_(removes),
-                )).all()
-
-            for tm, tc in remove_tags:
-                object_session(self).delete(tm)
-                tc.minus_references()
+            db.execute(tag_mark.delete().where(
+                tag_mark.c.id.in_([old_tags[tag][0] for tag in removes])))
 
         ''' add tags '''
         if adds:
-            for tag in adds:
-                tm = TagMark(
-                    object_type_id  = self.object_type_id,
-                    object_pk       = self.id,
-                    user_id         = uid,
-                )
-                tm.mark_tag(object_session(self), tag)
-                object_session(self).add(tm)
+            db.execute(tag_mark.insert().values([dict(
+                tag_id          = tag_id,
+                object_type_id  = object_type_id,
+                object_pk       = self.id,
+                user_id         = uid,
+            ) for tag_id in add_ids]))
+
+        ''' references: -1 for removes, +1 for adds, written behind '''
+        for tag_id in remove_ids:
+            tag_references.add(db, tag_content, tag_id, 'references', -1)
+        for tag_id in add_ids:
+            tag_references.add(db, tag_content, tag_id, 'references', 1)
+
+    def user_tags_page(self, uid, cursor=None, limit=10):
+        ''' Keyset page of (TagMark, TagContent), oldest first. '''
+        query = object_session(self).query(TagMark, TagContent)\
+            .join(TagContent, TagMark.tag_id==TagContent.id)\
+            .filter(and_(
+                TagMark.object_type_id      == self.object_type_id,
+                TagMark.object_pk           == self.id,
+                TagMark.user_id             == uid,
+            ))
+        return keyset_page(query, TagMark._created, TagMark.id, cursor, limit,
+            desc=False, key=lambda row: (row[0]._created, row[0].id))
 
     def tags(self, uid, quantity=10):
         return ' '.join(map(
@@ -111,6 +218,72 @@ class AbstractTagModel(object):
             self.get_user_tags(uid, quantity),
         ))
 
+class AbstractCounterModel(object):
+    ''' count_* columns written behind through counter.hit_counters. '''
+
+    def _counter_table(self, column):
+        if column not in HIT_COUNTERS.get(self.__table_name__, ()):
+            raise SqlaException('Unknow counter %s.%s' % (self.__table_name__, column))
+        return metadata.tables[self.__table_name__]
+
+    def incr_counter(self, column, delta=1):
+        hit_counters.incr(object_session(self), self._counter_table(column),
+            self.id, column, delta)
+
+    def get_counter(self, column):
+        ''' Loaded value plus the deltas not written yet. '''
+        return getattr(self, column) + hit_counters.pending(object_session(self),
+            self._counter_table(column), self.id, column)
+
+class AbstractCachedModel(object):
+    ''' Read-mostly rows served from cache.entities as detached copies,
+    by primary key or by a unique key of the table.
+    '''
+
+    @classmethod
+    def cached(cls, db, pk):
+        return entities.get(db, cls, pk)
+
+    @classmethod
+    def cached_by(cls, db, **kw):
+        return entities.get_by(db, cls, **kw)
+
+class AbstractListingModel(object):
+    ''' Listing pages without per-row deferred subqueries.
+
+    __listing_name__: (attribute, name table, foreign key column)
+    __listing_content__: (attribute, content table, foreign key column)
+    '''
+    __listing_name__    = None
+    __listing_content__ = None
+
+    @classmethod
+    def listing(cls, db, start=0, offset=20, filters=(), order_by=None,
+            with_content=False):
+        ''' Rows [start:offset] with their name filled in by one JOIN and,
+        if with_content, their content by one batched IN query.
+        '''
+        table = metadata.tables[cls.__table_name__]
+        attr, name_table, fk = cls.__listing_name__
+        query = db.query(cls, name_table.c.name)\
+            .outerjoin(name_table, table.c[fk]==name_table.c.id)\
+            .filter(*filters)\
+            .order_by(table.c.id.desc() if order_by is None else order_by)
+
+        details = []
+        for detail, name in query[start:offset]:
+            set_committed_value(detail, attr, name)
+            details.append(detail)
+
+        if with_content and details:
+            attr, content_table, fk = cls.__listing_content__
+            contents = dict(db.execute(
+                select([content_table.c[fk], content_table.c.content])\
+                .where(content_table.c[fk].in_([d.id for d in details]))).fetchall())
+            for detail in details:
+                set_committed_value(detail, attr, contents.get(detail.id))
+        return details
+
 class UserBase(BaseModel): 
     __table_name__ = user_base.name
 
@@ -130,16 +303,18 @@ class UserBase(BaseModel):
     def last_login(self, datetime):
         self._last_login = datetime2int(datetime)
 
-    def _set_password(self, password):
+    def _set_password(self, password, executor=None):
+        from core.hash import random_string, random_token
         self.secret = random_string()
         self.login_sequence = random_token()
-        self.password = hash_password(_u(password), self.secret)
+        self.password = hash_password(password, self.secret, executor)
 
-    def create_user(self, email, username, password, ipaddr):
-        self.secret = random_string()
+    def create_user(self, email, username, password, ipaddr, executor=None):
+        ''' executor: a hashing.HashExecutor to hash on, see hashing.py '''
+        from core.hash import random_token
         self.email = email
         self.username = username
-        self._set_password(password)
+        self._set_password(password, executor)
         self.login_addr = ipaddr
         self.active_token = random_token()
         self.user_profile = UserProfile()
@@ -150,37 +325,72 @@ class UserBase(BaseModel):
     def create_root(self):
         self.admin, self.root = 1, 1
 
-    def reset_password(self, old, new):
-        if self.password == hash_password(old, self.secret):
-            self._set_password(new)
-            msg = repr((u'更新了密码.', {}))
-            create_object_type(object_session(self), UserEvent, self, self.id,\
-                user_id=self.id, message=msg,
-            )
+    def verify_password(self, password, executor=None):
+        return verify_password(password, self.secret, self.password, executor)
+
+    def reset_password(self, old, new, executor=None):
+        if not self.verify_password(old, executor):
+            return False
+        self._set_password(new, executor)
+        msg = encode_message(u'更新了密码.', {})
+        create_object_type(object_session(self), UserEvent, self, self.id,\
+            user_id=self.id, message=msg,
+        )
+        return True
 
     def attention_to(self, people_id):
         ''' 是否跟随了某人
         '''
-        pass
+        return people_id in follow_graph.following_many(object_session(self),
+            self.id, [people_id])
 
     def followed_by(self, people_id):
         ''' 是否被某人跟随了
         '''
-        pass
+        return people_id in follow_graph.followed_many(object_session(self),
+            self.id, [people_id])
+
+    def follow(self, people_id):
+        ''' Both rows of the follow, see follow.py; following twice is a
+        no-op.
+        '''
+        db = object_session(self)
+        db.execute(upsert(user_relation,
+                db.get_bind(mapper=inspect(self)).dialect,
+                ('user_id', 'target_id', 'reverse')), [
+            dict(user_id=self.id, target_id=people_id, reverse=0),
+            dict(user_id=people_id, target_id=self.id, reverse=1),
+        ])
+        follow_graph.forget(db, self.id, people_id)
+
+    def unfollow(self, people_id):
+        db = object_session(self)
+        ur = user_relation.c
+        db.execute(user_relation.delete().where(or_(
+            and_(ur.user_id == self.id, ur.target_id == people_id,
+                ur.reverse == 0),
+            and_(ur.user_id == people_id, ur.target_id == self.id,
+                ur.reverse == 1),
+        )))
+        follow_graph.forget(db, self.id, people_id)
 
     def get_friendtags(self, start=0, offset=10):
         return object_session(self).query(UserFriendtag)\
             .filter(UserFriendtag.user_id==self.id)[start:offset]
 
+    def get_friend_groups(self):
+        ''' [UserFriendtag] with group_friends loaded, in two SELECTs '''
+        return load_friend_groups(object_session(self), self.id)
+
+    def friendtags_page(self, cursor=None, limit=10):
+        ''' Keyset page of UserFriendtag, oldest first. '''
+        query = object_session(self).query(UserFriendtag)\
+            .filter(UserFriendtag.user_id==self.id)
+        return keyset_page(query, UserFriendtag._created, UserFriendtag.id,
+            cursor, limit, desc=False)
+
     def init_session(self):
-        return dict(id=self.id, email=self.email, username=self.username,\
-            gender=self.user_profile.gender, thumb=self.user_profile.thumb,\
-            last_name=self.user_profile.last_name, first_name=self.user_profile.first_name,\
-            fullname=self.user_profile.fullname, nickname=self.user_profile.nickname,\
-            created=self.created, last_login=self.last_login, admin=self.admin, root=self.root,\
-            login_addr=self.login_addr, login_sequence=self.login_sequence, login_token=self.login_token,\
-            _last_login=self._last_login, modified=self.modified, _modified=self._modified,\
-        )
+        return load_session(object_session(self), self.id, self._modified)
 
 class UserProfile(BaseModel): 
     __table_name__ = user_profile.name
@@ -229,47 +439,38 @@ class UserImage(BaseModel):
 class UserGallery(BaseModel):
     __table_name__ = user_gallery.name
 
-class UserEvent(BaseModel):
-    ''' message: (str, dict)
+class UserEvent(AbstractGenericModel, BaseModel):
+    ''' message: (str, dict), see message.py
     '''
     __table_name__ = user_event.name
 
     @hybrid_property
     def format_message(self):
-        try:
-            msg, params = eval(self.message)
-            if isinstance(msg, (str, unicode)) and isinstance(params, dict):
-                return Template(msg).render(**params)
-        except:
-            return None
+        return render_message(self.message)
 
     def set_message(self, msg, **kw):
-        self.message = repr((msg, kw))
+        self.message = encode_message(msg, kw)
 
 
-class NewsCategory(BaseModel): 
+class NewsCategory(AbstractCachedModel, BaseModel):
     __table_name__ = news_category.name
 
-class NewsDetail(BaseModel): 
+class NewsDetail(AbstractCommentModel, AbstractListingModel, BaseModel): 
     __table_name__ = news_detail.name
-
-    def get_comments(self, start=0, offset=10):
-        return object_session(self).query(SiteComment)\
-            .filter(and_(
-                SiteComment.object_type_id  == self.object_type_id,
-                SiteComment.object_pk       == self.id,
-                SiteComment.show            == 1,
-            )).order_by(SiteComment._created.desc())[start:offset]
+    __listing_name__    = ('category', news_category, 'category_id')
+    __listing_content__ = ('content', news_content, 'news_id')
 
 class NewsContent(BaseModel): 
     __table_name__ = news_content.name
 
 
-class GameTaxonomy(BaseModel):
+class GameTaxonomy(AbstractCachedModel, BaseModel):
     __table_name__ = game_taxonomy.name
 
-class GameDetail(AbstractTagModel, BaseModel): 
+class GameDetail(AbstractTagModel, AbstractCommentModel, AbstractCounterModel, AbstractListingModel, BaseModel): 
     __table_name__ = game_detail.name
+    __listing_name__    = ('genre', game_taxonomy, 'genre_id')
+    __listing_content__ = ('content', game_content, 'game_id')
 
 class GameContent(BaseModel): 
     __table_name__ = game_content.name
@@ -303,9 +504,14 @@ class GroupDetail(BaseModel):
 class GroupMember(BaseModel):
     __table_name__ = group_member.name
 
-class GroupTopic(BaseModel):
+class GroupTopic(AbstractCounterModel, BaseModel):
     __table_name__ = group_topic.name
 
+    def add_reply(self, db, user_id, content, **kw):
+        reply = reply_topic(db, self.id, user_id, content, self.group_id, **kw)
+        db.expire(self, ['count_reply', 'recently_reply'])
+        return reply
+
 class GroupReply(BaseModel):
     __table_name__ = group_reply.name
 
@@ -314,34 +520,34 @@ class TagContent(BaseModel):
     __table_name__ = tag_content.name 
 
     def add_references(self, add=1):
-        self.references = self.references + add
+        ''' Persisted rows get a buffered `references + add`, see counter.py. '''
+        if self.id is None:
+            self.references = max((self.references or 0) + add, 0)
+        else:
+            tag_references.add(object_session(self), tag_content, self.id,
+                'references', add)
 
     def minus_references(self, minus=1):
-        self.references = self.references - 1 if self.references > 0 else 0
+        self.add_references(-minus)
 
-class TagMark(BaseModel):
+class TagMark(AbstractGenericModel, BaseModel):
     __table_name__ = tag_mark.name
 
     def mark_tag(self, db, tag):
-        tc = db.query(TagContent)\
-            .filter(TagContent.content==tag).first()
-
-        if tc:
-            tc.add_references()
-            self.tag_id         = tc.id
-        else:
-            self.tag_content    = TagContent(content=tag, references=0)
-            self.tag_content.add_references()
+        tc, created = get_or_create(db, TagContent,
+            content=normalize_tag(tag))
+        tc.add_references()
+        self.tag_id = tc.id
         return self
 
     def unmark_tag(self):
         self.tag_content.minus_references()
         return self
 
-class SiteSeo(BaseModel):
+class SiteSeo(AbstractGenericModel, AbstractCachedModel, BaseModel):
     __table_name__ = site_seo.name
 
-class SiteModel(BaseModel):
+class SiteModel(AbstractCachedModel, BaseModel):
     __table_name__ = site_model.name
 
     @hybrid_property
@@ -353,117 +559,404 @@ class SiteModel(BaseModel):
     def table_name(self):
         return '%s_%s' % (self.app_label, self.model)
 
-class SiteComment(BaseModel):
+class SiteComment(AbstractGenericModel, BaseModel):
     __table_name__ = site_comment.name
 
-mapper(UserBase, user_base, properties={
-    'user_profile': relationship(UserProfile, uselist=False, backref='user_base'),
-    'user_albums': relationship(UserAlbum, backref='user_base', order_by=user_album.c.id),
-    'user_events': relationship(UserEvent, backref='user_base', order_by=user_event.c._created.desc()),
-    'user_friendtags': relationship(UserFriendtag, backref='user_base', order_by=user_friendtag.c.id),
-    'user_relations': relationship(UserRelation, 
-        primaryjoin=user_base.c.id==user_relation.c.user_id,
-        backref='user_base', 
-        order_by=user_relation.c._created.desc(),
-    ),
-})
-
-mapper(UserProfile, user_profile, properties={
-    'news_details': relationship(NewsDetail, 
-        backref='user_profile', order_by=news_detail.c.id,
-    ),
-    'user_friendtags': relationship(UserFriendtag,
-        secondary=user_friendsgroup, backref='user_profile',
-    ),
-    'username': deferred(
-        select([user_base.c.username]).where(user_base.c.id==user_profile.c.user_id),
-    ),
-    'comments': relationship(SiteComment, 
-        backref='user_profile', order_by=site_comment.c._created.desc(),
-    ),
-})
-mapper(UserRelation, user_relation)
-mapper(UserFriendtag, user_friendtag, properties={
-    'group_friends': relationship(UserProfile,
-        secondary=user_friendsgroup, backref='user_friendtag',
-    ),
-})
-mapper(UserFriendsgroup, user_friendsgroup)
-mapper(UserMail, user_mail)
-mapper(UserMessage, user_message)
-mapper(UserAlbum, user_album)
-mapper(UserImage, user_image)
-mapper(UserGallery, user_gallery)
-mapper(UserEvent, user_event)
-
-
-mapper(NewsCategory, news_category, properties={
-    'news_details': relationship(NewsDetail, 
-        backref='news_category', order_by=news_detail.c.id,
-    ),
-})
-mapper(NewsDetail, news_detail, properties={
-    'news_content': relationship(NewsContent, 
-        uselist=False, backref='news_detail',
-    ),
-    'category': deferred(
-        select([news_category.c.name]).where(news_category.c.id==news_detail.c.category_id),
-    ),
-    'content': deferred(
-        select([news_content.c.content]).where(news_content.c.news_id==news_detail.c.id),
-    ),
-})
-mapper(NewsContent, news_content)
-
-
-mapper(GameTaxonomy, game_taxonomy, properties={
-    'game_details': relationship(GameDetail, 
-        backref='game_taxonomy', order_by=game_detail.c.id,
-    ),
-})
-
-mapper(GamePlatform, game_platform)
-
-mapper(GameContent, game_content)
-
-mapper(GameDetail, game_detail, properties={
-    'game_content': relationship(GameContent, 
-        uselist=False, backref='game_detail',
-    ),
-    'game_marks': relationship(GameMark,
-        backref='game_detail', order_by=game_mark.c.id,
-    ),
-    'genre': deferred(
-        select([game_taxonomy.c.name]).where(game_taxonomy.c.id==game_detail.c.genre_id),
-    ),
-    'content': deferred(
-        select([game_content.c.content]).where(game_content.c.game_id==game_detail.c.id),
-    ),
-})
-
-mapper(GameMark, game_mark)
-
-mapper(GroupDetail, group_detail)
-
-
-mapper(TagContent, tag_content, properties={
-    'tag_marks': relationship(TagMark,
-        backref='tag_content', order_by=tag_mark.c.id,
-    ),
-})
-mapper(TagMark, tag_mark)
-
-mapper(SiteSeo, site_seo)
-mapper(SiteComment, site_comment)
-mapper(SiteModel, site_model)
+''' login session dicts, keyed user id => (_modified, session) '''
+session_cache = LRUCache(maxsize=10000, ttl=600)
+session_eviction = CommitEviction(session_cache, 'login_session')
+
+def load_session(db, uid, modified=None, cache=session_cache):
+    ''' Login session dict of a user from one user_base/user_profile SELECT.
+
+    When `modified` (the user's _modified) matches the cached snapshot
+    the database is not touched. Pass cache=None to always query.
+    '''
+    if cache is not None and modified is not None:
+        cached = cache.get(uid)
+        if cached is not None and cached[0] == modified:
+            return dict(cached[1])
+
+    row = db.execute(select([
+        user_base.c.id, user_base.c.email, user_base.c.username,
+        user_base.c.admin, user_base.c.root, user_base.c._login_addr,
+        user_base.c.login_sequence, user_base.c.login_token,
+        user_base.c._last_login, user_base.c._created, user_base.c._modified,
+        user_profile.c.gender, user_profile.c.thumb_id,
+        user_profile.c.last_name, user_profile.c.first_name,
+        user_profile.c.nickname,
+    ]).select_from(
+        user_base.outerjoin(user_profile, user_profile.c.user_id==user_base.c.id),
+    ).where(user_base.c.id==uid)).first()
+    if row is None:
+        return None
+
+    fullname = '%s %s' % (row.last_name, row.first_name)\
+        if row.last_name is not None and row.first_name is not None else None
+    session = dict(id=row.id, email=row.email, username=row.username,\
+        gender=row.gender, thumb=row.thumb_id,\
+        last_name=row.last_name, first_name=row.first_name,\
+        fullname=fullname, nickname=row.nickname,\
+        created=int2datetime(row._created), last_login=int2datetime(row._last_login),\
+        admin=row.admin, root=row.root,\
+        login_addr=num2ip(row._login_addr), login_sequence=row.login_sequence,\
+        login_token=row.login_token, _last_login=row._last_login,\
+        modified=int2datetime(row._modified), _modified=row._modified,\
+    )
+    if cache is not None:
+        cache.set(uid, (row._modified, session))
+    return dict(session)
+
+def _forget_session(mapper, connection, target):
+    ''' A profile update leaves user_base._modified as it was, so a reader
+    between flush and commit would cache the old profile as current.
+    '''
+    session_eviction.forget(object_session(target),
+        target.user_id if isinstance(target, UserProfile) else target.id)
+
+''' SiteSeo fields keyed (object_type_id, object_pk) => dict, None for none '''
+seo_cache = LRUCache(maxsize=50000, ttl=3600)
+seo_eviction = CommitEviction(seo_cache, 'site_seo')
+SEO_FIELDS = ('id', 'page_title', 'page_keyword', 'page_description')
+
+def resolve_seo(db, objects, cache=seo_cache):
+    ''' {(object_type_id, object_pk): SEO_FIELDS dict or None} of a page of
+    objects. Misses are cached too; whatever is not cached costs one
+    SELECT for the whole page. Pass cache=None to always query.
+    '''
+    keys = set((_object_type_id(db, obj), obj.id)
+        for obj in objects if obj is not None)
+    found, missing = {}, []
+    for key in keys:
+        value = cache.get(key, cache) if cache is not None else cache
+        if value is cache:
+            missing.append(key)
+        else:
+            found[key] = value
+
+    if missing:
+        loaded = dict.fromkeys(missing)
+        ss = site_seo
+        rows = db.execute(select([ss.c.object_type_id, ss.c.object_pk] +
+            [ss.c[name] for name in SEO_FIELDS])\
+            .where(_keys_filter(ss, missing)).order_by(ss.c.id.desc()))
+        for row in rows:
+            ''' the oldest row wins if an object has several '''
+            loaded[(row.object_type_id, row.object_pk)] = dict(
+                (name, row[name]) for name in SEO_FIELDS)
+        for key, value in loaded.iteritems():
+            if cache is not None:
+                cache.set(key, value)
+        found.update(loaded)
+    return dict((key, value and dict(value))
+        for key, value in found.iteritems())
+
+def get_seo(db, obj, cache=seo_cache):
+    seo = resolve_seo(db, [obj], cache)
+    return seo.popitem()[1] if seo else None
+
+def _forget_seo(mapper, connection, target):
+    ''' The key the row has now and the one it had before this flush. '''
+    state = inspect(target)
+    old = [state.attrs[name].history.deleted for name in
+        ('object_type_id', 'object_pk')]
+    seo_eviction.forget(object_session(target),
+        (target.object_type_id, target.object_pk),
+        (old[0][0] if old[0] else target.object_type_id,
+        old[1][0] if old[1] else target.object_pk))
+
+''' first page of each group feed, keyed group id => (rows, next_cursor) '''
+feed_cache = LRUCache(maxsize=5000, ttl=300)
+feed_eviction = CommitEviction(feed_cache, 'group_feed')
+FEED_PAGE = 20
+
+def _feed_columns():
+    gt = group_topic.c
+    return [gt.enable_top, gt.top_sort, gt.recently_reply, gt.id]
+
+def group_feed(db, group_id, cursor=None, limit=FEED_PAGE, cache=feed_cache):
+    ''' Return ([topic dict], next_cursor) of a group: visible topics,
+    pinned first by top_sort, then by latest reply. Walks the
+    ix_group_topic_feed index; the first FEED_PAGE topics are cached
+    until a topic of the group changes or gets a reply.
+    '''
+    cached = cache is not None and cursor is None and limit == FEED_PAGE
+    if cached:
+        page = cache.get(group_id)
+        if page is not None:
+            return [dict(row) for row in page[0]], page[1]
+
+    query = db.query(*group_topic.c).filter(and_(
+        group_topic.c.group_id == group_id,
+        group_topic.c.hide == 0,
+    ))
+    rows, next_cursor = keyset_page_by(query, _feed_columns(), cursor, limit)
+    rows = [row._asdict() for row in rows]
+    if cached:
+        cache.set(group_id, ([dict(row) for row in rows], next_cursor))
+    return rows, next_cursor
+
+def reply_topic(db, topic_id, user_id, content, group_id=None, **kw):
+    ''' Add a GroupReply and bump its topic's count_reply and
+    recently_reply in one UPDATE rather than a read-modify-write.
+    group_id: the topic's group, looked up when not given
+    '''
+    reply = GroupReply(topic_id=topic_id, user_id=user_id, content=content,
+        **kw)
+    db.add(reply)
+    db.execute(group_topic.update().where(group_topic.c.id == topic_id)\
+        .values(count_reply=group_topic.c.count_reply + 1,
+            recently_reply=func.unix_timestamp()))
+    if group_id is None:
+        group_id = db.execute(select([group_topic.c.group_id])\
+            .where(group_topic.c.id == topic_id)).scalar()
+    feed_eviction.forget(db, group_id)
+    return reply
+
+def _forget_feed(mapper, connection, target):
+    ''' GroupTopic events: the group now and before this flush. '''
+    feed_eviction.forget(object_session(target), target.group_id,
+        *inspect(target).attrs.group_id.history.deleted)
+
+''' friend groups of a user, uid => ((tag id, name, (member user ids)),) '''
+friends_cache = LRUCache(maxsize=10000, ttl=600)
+friends_eviction = CommitEviction(friends_cache, 'friend_groups')
+
+def load_friend_groups(db, uid):
+    ''' [UserFriendtag] of a user with group_friends loaded: one SELECT of
+    the tags and one of the member profiles of them all.
+    '''
+    return db.query(UserFriendtag)\
+        .filter(UserFriendtag.user_id == uid)\
+        .options(selectinload(UserFriendtag.group_friends))\
+        .order_by(UserFriendtag.id).all()
+
+def friend_groups(db, uid, cache=friends_cache):
+    ''' ((tag id, name, (member user ids)),) of a user, tags by id and
+    members by user id, from one SELECT; cached until a UserFriendtag or
+    UserFriendsgroup of the user is flushed. Pass cache=None to always
+    query.
+    '''
+    if cache is not None:
+        groups = cache.get(uid)
+        if groups is not None:
+            return groups
+
+    ft, fg = user_friendtag.c, user_friendsgroup.c
+    groups = []
+    for id, name, target_id in db.execute(select([ft.id, ft.name,
+            fg.target_id]).select_from(outerjoin(user_friendtag,
+            user_friendsgroup, fg.friendtag_id == ft.id))\
+            .where(ft.user_id == uid).order_by(ft.id, fg.target_id)):
+        if not groups or groups[-1][0] != id:
+            groups.append((id, name, []))
+        if target_id is not None:
+            groups[-1][2].append(target_id)
+    groups = tuple((id, name, tuple(members)) for id, name, members in groups)
+    if cache is not None:
+        cache.set(uid, groups)
+    return groups
+
+def _forget_friends(mapper, connection, target):
+    ''' UserFriendtag and UserFriendsgroup events: the owner now and
+    before this flush.
+    '''
+    friends_eviction.forget(object_session(target), target.user_id,
+        *inspect(target).attrs.user_id.history.deleted)
+
+_mapped = False
+''' the thread running setup_mappers, whose lookups must not map again '''
+_mapping = None
+_mapper_lock = threading.Lock()
+
+def setup_mappers():
+    ''' Map every model class. Runs once, on the first session transaction,
+    model instance or mapped class attribute, so importing orm stays
+    cheap; call it directly to map eagerly.
+    '''
+    global _mapped, _mapping
+    with _mapper_lock:
+        if _mapped:
+            return
+        _mapping = threading.current_thread()
+        mapper(UserBase, user_base, properties={
+            'user_profile': relationship(UserProfile, uselist=False, backref='user_base'),
+            'user_albums': relationship(UserAlbum,
+                secondary=user_gallery,
+                primaryjoin=user_base.c.id==user_gallery.c.user_id,
+                secondaryjoin=user_gallery.c.id==user_album.c.gallery_id,
+                order_by=user_album.c.id, viewonly=True,
+            ),
+            'user_events': relationship(UserEvent, backref='user_base', order_by=user_event.c._created.desc()),
+            'user_friendtags': relationship(UserFriendtag, backref='user_base', order_by=user_friendtag.c.id),
+            'user_relations': relationship(UserRelation, 
+                primaryjoin=user_base.c.id==user_relation.c.user_id,
+                backref='user_base', 
+                order_by=user_relation.c._created.desc(),
+            ),
+        })
+
+        mapper(UserProfile, user_profile, properties={
+            'news_details': relationship(NewsDetail,
+                primaryjoin=user_profile.c.user_id==news_detail.c.user_id,
+                foreign_keys=[news_detail.c.user_id],
+                order_by=news_detail.c.id, viewonly=True,
+            ),
+            'user_friendtags': relationship(UserFriendtag,
+                secondary=user_friendsgroup,
+                primaryjoin=user_profile.c.user_id==user_friendsgroup.c.target_id,
+                secondaryjoin=user_friendsgroup.c.friendtag_id==user_friendtag.c.id,
+                foreign_keys=[user_friendsgroup.c.target_id,
+                    user_friendsgroup.c.friendtag_id],
+                viewonly=True,
+            ),
+            'username': deferred(
+                select([user_base.c.username]).where(user_base.c.id==user_profile.c.user_id),
+            ),
+            'comments': relationship(SiteComment,
+                primaryjoin=user_profile.c.user_id==site_comment.c.user_id,
+                foreign_keys=[site_comment.c.user_id],
+                order_by=site_comment.c._created.desc(), viewonly=True,
+            ),
+        })
+        mapper(UserRelation, user_relation)
+        mapper(UserFriendtag, user_friendtag, properties={
+            'group_friends': relationship(UserProfile,
+                secondary=user_friendsgroup,
+                primaryjoin=user_friendtag.c.id==user_friendsgroup.c.friendtag_id,
+                secondaryjoin=user_friendsgroup.c.target_id==user_profile.c.user_id,
+                foreign_keys=[user_friendsgroup.c.friendtag_id,
+                    user_friendsgroup.c.target_id],
+                order_by=user_profile.c.user_id,
+                viewonly=True,
+            ),
+        })
+        mapper(UserFriendsgroup, user_friendsgroup)
+        mapper(UserMail, user_mail)
+        mapper(UserMessage, user_message)
+        mapper(UserAlbum, user_album)
+        mapper(UserImage, user_image)
+        mapper(UserGallery, user_gallery)
+        mapper(UserEvent, user_event)
+
+
+        mapper(NewsCategory, news_category, properties={
+            'news_details': relationship(NewsDetail, 
+                backref='news_category', order_by=news_detail.c.id,
+            ),
+        })
+        mapper(NewsDetail, news_detail, properties={
+            'news_content': relationship(NewsContent, 
+                uselist=False, backref='news_detail',
+            ),
+            'category': deferred(
+                select([news_category.c.name]).where(news_category.c.id==news_detail.c.category_id),
+            ),
+            'content': deferred(
+                select([news_content.c.content]).where(news_content.c.news_id==news_detail.c.id),
+            ),
+        })
+        mapper(NewsContent, news_content)
+
+
+        mapper(GameTaxonomy, game_taxonomy, properties={
+            'game_details': relationship(GameDetail, 
+                backref='game_taxonomy', order_by=game_detail.c.id,
+            ),
+        })
+
+        mapper(GamePlatform, game_platform)
+
+        mapper(GameContent, game_content)
+
+        mapper(GameDetail, game_detail, properties={
+            'game_content': relationship(GameContent, 
+                uselist=False, backref='game_detail',
+            ),
+            'game_marks': relationship(GameMark,
+                backref='game_detail', order_by=game_mark.c.id,
+            ),
+            'genre': deferred(
+                select([game_taxonomy.c.name]).where(game_taxonomy.c.id==game_detail.c.genre_id),
+            ),
+            'content': deferred(
+                select([game_content.c.content]).where(game_content.c.game_id==game_detail.c.id),
+            ),
+        })
+
+        mapper(GameMark, game_mark, properties=dict(
+            (name, column_property(game_mark.c[name], active_history=True))
+            for name in rollup.HISTORY))
+
+        mapper(GroupDetail, group_detail, properties={
+            'group_topics': relationship(GroupTopic,
+                backref='group_detail', order_by=group_topic.c.id,
+            ),
+        })
+        mapper(GroupTopic, group_topic, properties={
+            'group_replies': relationship(GroupReply,
+                backref='group_topic', order_by=group_reply.c.id,
+            ),
+        })
+        mapper(GroupReply, group_reply)
+
+
+        mapper(TagContent, tag_content, properties={
+            'tag_marks': relationship(TagMark,
+                backref='tag_content', order_by=tag_mark.c.id,
+            ),
+        })
+        mapper(TagMark, tag_mark)
+
+        mapper(SiteSeo, site_seo)
+        mapper(SiteComment, site_comment)
+        mapper(SiteModel, site_model)
+
+        event.listen(SiteModel, 'after_insert', object_types.on_insert)
+        event.listen(SiteModel, 'after_update', object_types.on_delete)
+        event.listen(SiteModel, 'after_delete', object_types.on_delete)
+        event.listen(Session, 'after_commit', object_types.after_commit)
+        event.listen(Session, 'after_rollback', object_types.after_rollback)
+        event.listen(UserBase, 'after_update', _forget_session)
+        event.listen(UserProfile, 'after_update', _forget_session)
+        event.listen(SiteSeo, 'after_insert', _forget_seo)
+        event.listen(SiteSeo, 'after_update', _forget_seo)
+        event.listen(SiteSeo, 'after_delete', _forget_seo)
+        event.listen(GroupTopic, 'after_insert', _forget_feed)
+        event.listen(GroupTopic, 'after_update', _forget_feed)
+        event.listen(GroupTopic, 'after_delete', _forget_feed)
+        event.listen(UserRelation, 'after_insert', follow_graph.on_change)
+        event.listen(UserRelation, 'after_update', follow_graph.on_change)
+        event.listen(UserRelation, 'after_delete', follow_graph.on_change)
+        for cls in (UserFriendtag, UserFriendsgroup):
+            for name in ('after_insert', 'after_update', 'after_delete'):
+                event.listen(cls, name, _forget_friends)
+        for cls in AbstractCachedModel.__subclasses__():
+            entities.register(cls,
+                unique_keys(metadata.tables[cls.__table_name__]))
+        event.listen(Session, 'before_attach', entities.before_attach)
+        event.listen(Session, 'after_flush', entities.after_flush)
+        event.listen(Session, 'after_commit', entities.after_commit)
+        event.listen(Session, 'after_rollback', entities.after_rollback)
+        event.listen(Session, 'before_flush', rollup.before_flush)
+        event.listen(Session, 'after_flush', rollup.after_flush)
+        event.listen(Session, 'after_commit', rollup.after_commit)
+        event.listen(Session, 'after_rollback', rollup.after_rollback)
+        _mapping = None
+        _mapped = True
+
+@event.listens_for(Session, 'after_transaction_create')
+def _setup_mappers(session, transaction):
+    _mapped or setup_mappers()
+
+def _object_type_id(db, obj):
+    object_type_id = object_types.get_table_id(db, obj.__table_name__)
+    if object_type_id is None:
+        raise SqlaException('Unknow object type %s' % obj.__table_name__)
+    return object_type_id
 
 def create_object_type(db, ct_obj, obj, pk, *a, **kw):
-    app_label, model = obj.__table_name__.split('_', 1)
-    object_type_id = db.query(SiteModel)\
-        .filter(and_(
-            SiteModel.app_label==app_label,
-            SiteModel.model==model,
-        )).first().id
+    object_type_id = _object_type_id(db, obj)
     kw.update(dict(
         object_type_id=object_type_id, 
         object_pk=pk,
@@ -472,21 +965,280 @@ def create_object_type(db, ct_obj, obj, pk, *a, **kw):
 
 def get_object_type(db, ct_obj, obj, pk, **kw):
     ''' Return a query string object without fetch. '''
-    app_label, model = obj.__table_name__.split('_', 1)
-    object_type_id = db.query(SiteModel)\
-        .filter(and_(
-            SiteModel.app_label==app_label,
-            SiteModel.model==model,
-        )).first().id
+    object_type_id = _object_type_id(db, obj)
     return db.query(ct_obj).filter(and_(
         ct_obj.object_type_id==object_type_id,
         ct_obj.object_pk==pk,
     )).filter_by(**kw).all()
 
+def supports_window_functions(bind):
+    ''' ROW_NUMBER() OVER: MySQL 8+, MariaDB 10.2+, SQLite 3.25+, others. '''
+    dialect = bind.dialect
+    version = dialect.server_version_info or ()
+    if dialect.name == 'mysql':
+        if getattr(dialect, '_is_mariadb', False):
+            return version >= (10, 2)
+        return version >= (8, 0)
+    if dialect.name == 'sqlite':
+        return version >= (3, 25)
+    return True
+
+def _object_filter(db, table, objects):
+    ''' (object_type_id, object_pk) IN the given objects, grouped by type. '''
+    return _keys_filter(table,
+        [(_object_type_id(db, obj), obj.id) for obj in objects])
+
+def _keys_filter(table, keys):
+    pks = {}
+    for object_type_id, pk in keys:
+        pks.setdefault(object_type_id, []).append(pk)
+    return or_(*[and_(
+        table.c.object_type_id  == object_type_id,
+        table.c.object_pk.in_(ids),
+    ) for object_type_id, ids in pks.iteritems()])
+
+def prefetch_comments(db, objects, per_object=10):
+    ''' Load the newest `per_object` visible comments of every object in
+    one query and attach them, so get_comments() needs no more SQL.
+    '''
+    objects = [obj for obj in objects if obj is not None]
+    if not objects:
+        return objects
+    sc = site_comment
+    where = and_(_object_filter(db, sc, objects), sc.c.hide == 0)
+    order = (sc.c._created.desc(), sc.c.id.desc())
+
+    if supports_window_functions(db.get_bind(clause=sc)):
+        ranked = select([sc.c.id, func.row_number().over(
+            partition_by=(sc.c.object_type_id, sc.c.object_pk),
+            order_by=order,
+        ).label('rn')]).where(where).alias()
+        query = db.query(SiteComment)\
+            .join(ranked, SiteComment.id==ranked.c.id)\
+            .filter(ranked.c.rn <= per_object)
+    else:
+        newer = sc.alias()
+        query = db.query(SiteComment).filter(and_(where, select([func.count()])\
+            .where(and_(
+                newer.c.object_type_id  == sc.c.object_type_id,
+                newer.c.object_pk       == sc.c.object_pk,
+                newer.c.hide            == 0,
+                or_(newer.c._created > sc.c._created, and_(
+                    newer.c._created == sc.c._created, newer.c.id > sc.c.id)),
+            )).as_scalar() < per_object))
+
+    comments = {}
+    for comment in query.order_by(*order):
+        comments.setdefault((comment.object_type_id, comment.object_pk), [])\
+            .append(comment)
+    for obj in objects:
+        obj._prefetched_comments = (
+            comments.get((obj.object_type_id, obj.id), []), per_object)
+    return objects
+
+def prefetch_tags(db, objects, uid):
+    ''' Load uid's tags on every object in one query and attach them, so
+    get_user_tags(uid)/tags(uid) need no more SQL.
+    '''
+    objects = [obj for obj in objects if obj is not None]
+    if not objects:
+        return objects
+    tags = {}
+    for tm, tc in db.query(TagMark, TagContent)\
+            .join(TagContent, TagMark.tag_id==TagContent.id)\
+            .filter(and_(
+                _object_filter(db, tag_mark, objects),
+                TagMark.user_id == uid,
+            )).order_by(TagMark._created, TagMark.id):
+        tags.setdefault((tm.object_type_id, tm.object_pk), []).append((tm, tc))
+    for obj in objects:
+        if obj._prefetched_tags is None:
+            obj._prefetched_tags = {}
+        obj._prefetched_tags[uid] = tags.get((obj.object_type_id, obj.id), [])
+    return objects
+
+_models = {}
+
+def model_for_table(table_name):
+    ''' Mapped model class of a table name, None if there is none. '''
+    if not _models:
+        _mapped or setup_mappers()
+        stack = [BaseModel]
+        while stack:
+            cls = stack.pop()
+            stack.extend(cls.__subclasses__())
+            if getattr(cls, '__table_name__', None) and \
+                    inspect(cls, raiseerr=False) is not None:
+                _models[cls.__table_name__] = cls
+    return _models.get(table_name)
+
+def prefetch_targets(db, rows):
+    ''' Load the objects a batch of (object_type_id, object_pk) rows point
+    at, with one IN query per object type, and attach each as row.target.
+    Returns {(object_type_id, object_pk): object}.
+    '''
+    pks = {}
+    for row in rows:
+        pks.setdefault(row.object_type_id, set()).add(row.object_pk)
+
+    targets = {}
+    for object_type_id, ids in pks.iteritems():
+        table_name = object_types.get_table_name(db, object_type_id)
+        model = model_for_table(table_name) if table_name else None
+        if model is None:
+            continue
+        for obj in db.query(model).filter(model.id.in_(ids)):
+            targets[(object_type_id, obj.id)] = obj
+
+    for row in rows:
+        row._target = targets.get((row.object_type_id, row.object_pk))
+        row._target_loaded = True
+    return targets
+
+def normalize_tag(tag):
+    ''' The tag as tag_content.content stores it: unicode, cut to the
+    column length, so what is selected is what was inserted.
+    '''
+    if isinstance(tag, str):
+        tag = tag.decode('utf-8')
+    return tag[:tag_content.c.content.type.length]
+
+def resolve_tags(db, tags):
+    ''' Return {content: tag_content.id}, inserting the missing tags;
+    contents are normalize_tag()ed.
+    '''
+    tags = list(set(normalize_tag(tag) for tag in tags))
+    query = select([tag_content.c.content, tag_content.c.id])
+    resolved = dict(db.execute(
+        query.where(tag_content.c.content.in_(tags))).fetchall())
+    missing = [tag for tag in tags if tag not in resolved]
+    if missing:
+        db.execute(upsert(tag_content,
+            db.get_bind(mapper=inspect(TagContent)).dialect, ('content',)),
+            [dict(content=tag, references=0) for tag in missing])
+        resolved.update(db.execute(
+            query.where(tag_content.c.content.in_(missing))).fetchall())
+    return resolved
+
+def unique_keys(table):
+    ''' Column name tuples of the table's unique constraints, primary key
+    last.
+    '''
+    keys = [tuple(c.name for c in constraint.columns)
+        for constraint in table.constraints
+        if isinstance(constraint, UniqueConstraint)]
+    keys.extend(tuple(c.name for c in index.columns)
+        for index in table.indexes if index.unique)
+    keys.append(tuple(c.name for c in table.primary_key.columns))
+    return keys
+
+def _unique_key(table, names):
+    for key in unique_keys(table):
+        if set(key) <= names:
+            return key
+    return None
+
+class _InsertOnConflict(Insert):
+    ''' INSERT ... ON CONFLICT (key) DO NOTHING, see upsert(). '''
+
+    def __init__(self, table, key=None):
+        super(_InsertOnConflict, self).__init__(table)
+        self.conflict_key = key
+
+@compiles(_InsertOnConflict)
+def _compile_on_conflict(insert, compiler, **kw):
+    target = ''
+    if insert.conflict_key:
+        target = ' (%s)' % ', '.join(compiler.preparer.quote(name)
+            for name in insert.conflict_key)
+    return '%s ON CONFLICT%s DO NOTHING' % (
+        compiler.visit_insert(insert, **kw), target)
+
+def upsert(table, dialect, key=None):
+    ''' INSERT leaving the rows that hit unique key `key` (column names,
+    any unique key when None) as they are: ON DUPLICATE KEY UPDATE
+    <pk> = <pk> on MySQL, ON CONFLICT (key) DO NOTHING elsewhere. Other
+    errors, NOT NULL for one, still raise; MySQL cannot scope the clause
+    to one key, so callers check that the rows are there.
+    '''
+    if dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        pk = list(table.primary_key.columns)[0]
+        return insert(table).on_duplicate_key_update({pk.name: pk})
+    return _InsertOnConflict(table, key)
+
+def _key_filter(table, key, values):
+    if len(key) == 1:
+        return table.c[key[0]].in_(values)
+    return tuple_(*[table.c[name] for name in key]).in_(values)
+
 def get_or_create(db, obj, **kw):
+    ''' Return (instance, created).
+
+    When kw holds a unique key of the table the instance is persistent:
+    a SELECT on the key, and on a miss an upsert of kw and a second
+    SELECT, so concurrent callers all end up with the same row. On MySQL
+    (CLIENT_FOUND_ROWS) a row inserted by someone else in between still
+    counts as created. Without a unique key the instance is transient,
+    for the caller to add.
+    '''
     instance = db.query(obj).filter_by(**kw).first()
     if instance:
         return instance, False
-    else:
-        instance = obj(**kw)
-        return instance, True
+    table = metadata.tables[obj.__table_name__]
+    key = _unique_key(table, set(name for name, value in kw.iteritems()
+        if value is not None))
+    if key is None or not set(kw) <= set(table.c.keys()):
+        return obj(**kw), True
+
+    stmt = upsert(table, db.get_bind(mapper=inspect(obj)).dialect, key)
+    created = db.execute(stmt, kw).rowcount != 0
+    instance = db.query(obj).filter_by(**dict(
+        (name, kw[name]) for name in key)).first()
+    if instance is None:
+        raise SqlaException('Conflict on another unique key of %s: %r' % (
+            table.name, kw))
+    return instance, created
+
+def get_or_create_many(db, obj, rows, chunk=500):
+    ''' Return {key: instance} for a list of column dicts sharing a unique
+    key of obj's table; key is the value of a one-column key, a tuple
+    otherwise.
+
+    Per chunk of keys: a SELECT, one multi-row upsert of the missing ones
+    and a SELECT of those.
+    '''
+    if not rows:
+        return {}
+    table = metadata.tables[obj.__table_name__]
+    key = _unique_key(table, reduce(set.intersection,
+        (set(row) for row in rows)))
+    if key is None:
+        raise SqlaException('Unknow unique key of %s in %s' % (
+            table.name, sorted(rows[0])))
+    to_key = (lambda row: row[key[0]]) if len(key) == 1 else \
+        (lambda row: tuple(row[name] for name in key))
+    to_value = (lambda o: getattr(o, key[0])) if len(key) == 1 else \
+        (lambda o: tuple(getattr(o, name) for name in key))
+    dialect = db.get_bind(mapper=inspect(obj)).dialect
+
+    unique = {}
+    for row in rows:
+        unique.setdefault(to_key(row), row)
+    keys = unique.keys()
+    resolved = {}
+    for start in range(0, len(keys), chunk):
+        part = keys[start:start + chunk]
+        resolved.update((to_value(o), o) for o in db.query(obj)\
+            .filter(_key_filter(table, key, part)))
+        missing = [k for k in part if k not in resolved]
+        if missing:
+            db.execute(upsert(table, dialect, key),
+                [unique[k] for k in missing])
+            resolved.update((to_value(o), o) for o in db.query(obj)\
+                .filter(_key_filter(table, key, missing)))
+            lost = [k for k in missing if k not in resolved]
+            if lost:
+                raise SqlaException('Conflict on another unique key of %s: '
+                    '%r' % (table.name, unique[lost[0]]))
+    return resolved
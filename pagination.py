@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# coding: utf-8
+""" Keyset (cursor) pagination on (_created, id), or any column tuple.
+
+A page costs the same however deep it is, provided an index ends with
+the ordering columns after the filtered ones (see schema.py).
+"""
+import json
+import base64
+
+from sqlalchemy import or_,\
+                       and_
+
+from .base import SqlaException
+
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+def decode_cursor(cursor, size=2):
+    ''' The `size` ints a cursor holds. '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if len(values) != size:
+            raise ValueError(cursor)
+        return tuple(int(value) for value in values)
+    except (TypeError, ValueError):
+        raise SqlaException('Invalid cursor %r' % cursor)
+
+def keyset_filter(columns, values, desc=True):
+    ''' Rows strictly after `values` in (columns) order. '''
+    clauses = []
+    for i, column in enumerate(columns):
+        after = column < values[i] if desc else column > values[i]
+        clauses.append(and_(*[c == v for c, v in
+            zip(columns[:i], values[:i])] + [after]))
+    return or_(*clauses)
+
+def keyset_page_by(query, columns, cursor=None, limit=10, desc=True,
+        key=None):
+    ''' Return (rows, next_cursor) of a query ordered by the columns, all
+    ascending or all descending; next_cursor is None on the last page.
+
+    key: row => its values of the columns, by attribute name by default
+    '''
+    if key is None:
+        key = lambda row: tuple(getattr(row, c.key) for c in columns)
+    if cursor is not None:
+        query = query.filter(keyset_filter(columns,
+            decode_cursor(cursor, len(columns)), desc))
+    if desc:
+        query = query.order_by(*[column.desc() for column in columns])
+    else:
+        query = query.order_by(*columns)
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(*[int(value) for value in key(rows[-1])])
+
+def keyset_page(query, created, id, cursor=None, limit=10, desc=True,
+        key=lambda row: (row._created, row.id)):
+    ''' Return (rows, next_cursor); next_cursor is None on the last page.
+
+    created, id: the _created and id columns of the paged entity
+    key: row => (_created, id), for queries returning tuples
+    '''
+    return keyset_page_by(query, [created, id], cursor, limit, desc, key)
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# coding: utf-8
+import time
+import threading
+
+from sqlalchemy import select
+from sqlalchemy.orm import object_session
+
+from .schema import site_model, mods
+
+PENDING_KEY = 'object_types'
+
+
+def split_table_name(table_name):
+    ''' user_base => ('user', 'base') '''
+    return tuple(table_name.split('_', 1))
+
+class ObjectTypeRegistry(object):
+    ''' Process-wide (app_label, model) <=> site_model.id maps.
+
+    The whole site_model table is loaded once per engine and resolved
+    from memory afterwards. A miss reloads the table once, so rows added
+    by other processes are picked up without restarting; a key still
+    missing after that does not reload it again for miss_ttl seconds.
+
+    miss_ttl: seconds a miss is remembered
+    '''
+
+    def __init__(self, miss_ttl=60):
+        self.miss_ttl = miss_ttl
+        self._types = {}
+        self._names = {}
+        self._misses = {}
+        self._lock = threading.Lock()
+
+    def _engine(self, db):
+        bind = db.get_bind(clause=site_model) if hasattr(db, 'get_bind') else db
+        return getattr(bind, 'engine', bind)
+
+    def _load(self, db):
+        ''' (types, names) of the engine behind db, stored unless db has
+        SiteModel rows yet to commit.
+        '''
+        engine = self._engine(db)
+        rows = db.execute(select([
+            site_model.c.id,
+            site_model.c.app_label,
+            site_model.c.model,
+        ])).fetchall()
+        types = dict(((app_label, model), id) for id, app_label, model in rows)
+        names = dict((id, '%s_%s' % (app_label, model))
+            for id, app_label, model in rows)
+        if not getattr(db, 'info', {}).get(PENDING_KEY):
+            with self._lock:
+                self._types[engine] = types
+                self._names[engine] = names
+        return types, names
+
+    def load(self, db):
+        ''' (Re)load every site_model row for the engine behind db. '''
+        return self._load(db)[0]
+
+    def warm_up(self, db):
+        ''' Load the registry, inserting rows for any table in schema.mods
+        that has no site_model entry yet. Call once at process start.
+        '''
+        types = self.load(db)
+        missing = [m for m in mods if (m['app_label'], m['model']) not in types]
+        if missing:
+            db.execute(site_model.insert(), missing)
+            types = self.load(db)
+        return types
+
+    def _missed(self, engine, key):
+        ''' True when key missed less than miss_ttl ago. '''
+        expires = self._misses.get((engine, key))
+        if expires is None:
+            return False
+        if expires > time.time():
+            return True
+        self._misses.pop((engine, key), None)
+        return False
+
+    def _lookup(self, db, maps, key):
+        engine = self._engine(db)
+        found = maps.get(engine)
+        if found is not None and key in found:
+            return found[key]
+        if found is not None and self._missed(engine, key):
+            return None
+        found = self._load(db)[0 if maps is self._types else 1]
+        if key not in found:
+            self._misses[(engine, key)] = time.time() + self.miss_ttl
+        return found.get(key)
+
+    def get_id(self, db, app_label, model):
+        return self._lookup(db, self._types, (app_label, model))
+
+    def get_table_id(self, db, table_name):
+        return self.get_id(db, *split_table_name(table_name))
+
+    def get_table_name(self, db, object_type_id):
+        ''' site_model.id => 'app_label_model', None if unknown. '''
+        return self._lookup(db, self._names, object_type_id)
+
+    def add(self, engine, id, app_label, model):
+        with self._lock:
+            types = self._types.get(engine)
+            if types is not None:
+                types[(app_label, model)] = id
+                self._names[engine][id] = '%s_%s' % (app_label, model)
+            self._misses.pop((engine, (app_label, model)), None)
+            self._misses.pop((engine, id), None)
+
+    def invalidate(self, engine=None):
+        with self._lock:
+            if engine is None:
+                self._types.clear()
+                self._names.clear()
+                self._misses.clear()
+            else:
+                self._types.pop(engine, None)
+                self._names.pop(engine, None)
+                for key in [key for key in self._misses if key[0] == engine]:
+                    del self._misses[key]
+
+    def _pending(self, target):
+        session = object_session(target)
+        return session.info.setdefault(PENDING_KEY, []) \
+            if session is not None else None
+
+    def on_insert(self, mapper, connection, target):
+        ''' SiteModel after_insert listener: published once committed. '''
+        pending = self._pending(target)
+        if pending is None:
+            self.invalidate(connection.engine)
+        else:
+            pending.append((connection.engine, target.id, target.app_label,
+                target.model))
+
+    def on_delete(self, mapper, connection, target):
+        ''' SiteModel after_delete/after_update listener: dropped now and
+        again once committed, in case a reload saw the old row meanwhile.
+        '''
+        self.invalidate(connection.engine)
+        pending = self._pending(target)
+        if pending is not None:
+            pending.append((connection.engine, None, None, None))
+
+    def after_commit(self, session):
+        for engine, id, app_label, model in session.info.pop(PENDING_KEY, ()):
+            if id is None:
+                self.invalidate(engine)
+            else:
+                self.add(engine, id, app_label, model)
+
+    def after_rollback(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+object_types = ObjectTypeRegistry()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# coding: utf-8
+""" game_detail totals rolled up from game_evaluation (GameMark) rows.
+
+A mark adds 1 to count_score and its score to total_score once scored
+(`scored` holds a timestamp). count_like/count_play are hit counters,
+see counter.py, and the total_graph/control/opera/music criteria live
+on game_review rather than on marks. Pending GameMark inserts, updates and deletes
+are staged before a flush and their difference is added to the parent
+games right after it, in the same transaction, one UPDATE per flush;
+rebuild() recomputes everything, chunk by chunk.
+
+Only marks written through the session are rolled up: Core statements
+on game_evaluation, including the upsert of get_or_create(db, GameMark,
+...), bypass it and need a rebuild() of the games they touch.
+"""
+from sqlalchemy import select,\
+                       func,\
+                       case,\
+                       and_
+from sqlalchemy.orm import attributes
+
+from .schema import game_detail,\
+                    game_mark
+from .counter import delta_update
+
+STAGED_KEY = 'score_rollup'
+GAMES_KEY = 'score_rollup_games'
+
+''' called as listener(session, game ids) once changed totals commit '''
+listeners = []
+
+''' game_detail column => game_evaluation value it adds up '''
+ROLLUPS = (
+    ('count_score', lambda mark: int(bool(mark['scored']))),
+    ('total_score', lambda mark: (mark['score'] or 0) if mark['scored'] else 0),
+)
+
+''' loaded before they are overwritten (active_history), see orm.py '''
+HISTORY = ('game_id', 'scored', 'score')
+
+''' GameMark => GameDetail relationship, whose id the flush copies to
+game_id only after before_flush '''
+PARENT = 'game_detail'
+
+
+def _values(obj, old=False):
+    ''' The mark's columns now, or before its pending changes; loads
+    what is expired, so only called from before_flush. A parent set
+    through the relationship wins over game_id: it is the game_id the
+    flush will write, and may be a GameDetail without an id yet.
+    '''
+    state = attributes.instance_state(obj)
+    values = {}
+    for name in HISTORY:
+        if old:
+            history = state.attrs[name].load_history()
+            values[name] = history.deleted[0] if history.deleted\
+                else (history.unchanged or [None])[0]
+        else:
+            values[name] = getattr(obj, name)
+    if not old and PARENT in state.attrs:
+        history = state.attrs[PARENT].history
+        if history.added or history.deleted:
+            values['game_id'] = (history.added or [None])[0]
+    return values
+
+def _stage(staged, values, sign):
+    ''' staged: {column: {game id or GameDetail: delta}} '''
+    if values['game_id'] is None:
+        return
+    for column, value in ROLLUPS:
+        delta = sign * value(values)
+        if delta:
+            deltas = staged.setdefault(column, {})
+            deltas[values['game_id']] = deltas.get(values['game_id'], 0) + delta
+
+def _game_id(parent):
+    return getattr(parent, 'id', parent)
+
+def before_flush(session, flush_context, instances):
+    ''' Stage the difference every pending GameMark makes. '''
+    staged = session.info.setdefault(STAGED_KEY, {})
+    for obj in session.new:
+        if getattr(obj, '__table_name__', None) == game_mark.name:
+            _stage(staged, _values(obj), 1)
+    for obj in session.dirty:
+        if getattr(obj, '__table_name__', None) == game_mark.name\
+                and session.is_modified(obj):
+            _stage(staged, _values(obj, old=True), -1)
+            _stage(staged, _values(obj), 1)
+    for obj in session.deleted:
+        if getattr(obj, '__table_name__', None) == game_mark.name:
+            _stage(staged, _values(obj, old=True), -1)
+
+def after_flush(session, flush_context):
+    ''' Apply the staged deltas, then expire them on loaded games. '''
+    staged = session.info.pop(STAGED_KEY, None) or {}
+    columns = {}
+    for column, parents in staged.iteritems():
+        deltas = {}
+        for parent, delta in parents.iteritems():
+            pk = _game_id(parent)
+            if pk is not None:
+                deltas[pk] = deltas.get(pk, 0) + delta
+        deltas = dict((pk, delta) for pk, delta in deltas.iteritems() if delta)
+        if deltas:
+            columns[column] = deltas
+    if not columns:
+        return
+    session.execute(delta_update(game_detail, columns, floor=0))
+
+    games = set()
+    for deltas in columns.itervalues():
+        games.update(deltas)
+    session.info.setdefault(GAMES_KEY, set()).update(games)
+    for obj in session.identity_map.values():
+        if getattr(obj, '__table_name__', None) == game_detail.name\
+                and obj.id in games:
+            session.expire(obj, list(columns))
+
+def after_commit(session):
+    games = session.info.pop(GAMES_KEY, None)
+    if games:
+        for listener in listeners:
+            listener(session, games)
+
+def after_rollback(session):
+    session.info.pop(STAGED_KEY, None)
+    session.info.pop(GAMES_KEY, None)
+
+def totals():
+    ''' {ROLLUPS column: total of the game's marks}, as scalar subqueries
+    correlated to the game_detail row being updated.
+    '''
+    gm = game_mark.c
+    marks = gm.game_id == game_detail.c.id
+    return {
+        'count_score': select([func.coalesce(func.sum(
+            case([(gm.scored != 0, 1)], else_=0)), 0)])\
+            .where(marks).as_scalar(),
+        'total_score': select([func.coalesce(func.sum(
+            case([(gm.scored != 0, gm.score)], else_=0)), 0)])\
+            .where(marks).as_scalar(),
+    }
+
+def rebuild(bind, chunk=1000, after=0, progress=None):
+    ''' Recompute the ROLLUPS columns of every game with id > after.
+
+    Each chunk of games is one SELECT of ids and one UPDATE ... SET
+    column = (SELECT ...) over their marks, committed on its own. The
+    totals are read by the statement that writes them, so deltas that
+    other sessions commit meanwhile are not overwritten. Pass the last
+    id handed to progress(last_id, games) as `after` to resume.
+    Return the number of games rebuilt.
+    '''
+    gd = game_detail.c
+    done, last = 0, after
+    conn = bind.connect()
+    try:
+        while True:
+            ids = [id for id, in conn.execute(select([gd.id])\
+                .where(gd.id > last).order_by(gd.id).limit(chunk))]
+            if not ids:
+                break
+            with conn.begin():
+                conn.execute(game_detail.update()\
+                    .where(and_(gd.id >= ids[0], gd.id <= ids[-1]))\
+                    .values(totals()))
+            done += len(ids)
+            last = ids[-1]
+            if progress:
+                progress(last, done)
+            if len(ids) < chunk:
+                break
+    finally:
+        conn.close()
+    return done
@@ -4,7 +4,8 @@ from sqlalchemy import Table,\
                        Column,\
                        MetaData,\
                        ForeignKey,\
-                       UniqueConstraint
+                       UniqueConstraint,\
+                       Index
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.mysql import INTEGER,\
                                       TINYINT,\
@@ -93,12 +94,15 @@ user_relation = Table('user_relation', metadata,
 
 user_friendtag = Table('user_friendtag', metadata,
         Column('id', INTEGER(unsigned=True), primary_key=True),
+        Column('user_id', INTEGER(unsigned=True), ForeignKey('user_base.id'),
+            nullable=False),
         Column('name', VARCHAR(32), nullable=False, index=True),
 
         Column('_created', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp()),
         Column('_modified', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp(), onupdate=func.unix_timestamp()),
+        Index('ix_user_friendtag_user_created', 'user_id', '_created', 'id'),
         mysql_engine = 'InnoDB',
         mysql_charset = 'utf8',
         )
@@ -117,6 +121,7 @@ user_friendsgroup = Table('user_friendsgroup', metadata,
         Column('_modified', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp(), onupdate=func.unix_timestamp()),
         UniqueConstraint('user_id', 'target_id'),
+        Index('ix_user_friendsgroup_friendtag', 'friendtag_id', 'target_id'),
         mysql_engine = 'InnoDB',
         mysql_charset = 'utf8',
         )
@@ -465,6 +470,7 @@ game_mark = Table('game_evaluation', metadata,
         Column('_modified', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp(), onupdate=func.unix_timestamp()),
         UniqueConstraint('user_id', 'game_id'),
+        Index('ix_game_evaluation_game_scored', 'game_id', 'scored', 'score'),
         mysql_engine = 'InnoDB',
         mysql_charset = 'utf8',
         )
@@ -594,13 +600,17 @@ group_topic = Table('group_topic', metadata,
         Column('count_visit', INTEGER(unsigned=True), nullable=False,
             default=0),
         # unix_timestamp, default = created
-        Column('recently_reply', INTEGER(unsigned=True), nullable=False),
+        Column('recently_reply', INTEGER(unsigned=True), nullable=False,
+            default=func.unix_timestamp()),
         Column('headline', VARCHAR(256)),
 
         Column('_created', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp()),
         Column('_modified', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp(), onupdate=func.unix_timestamp()),
+        # group feed order, see orm.group_feed
+        Index('ix_group_topic_feed', 'group_id', 'hide', 'enable_top',
+            'top_sort', 'recently_reply', 'id'),
         mysql_engine = 'InnoDB',
         mysql_charset = 'utf8',
         )
@@ -628,7 +638,7 @@ group_reply = Table('group_reply', metadata,
 tag_content = Table('tag_content', metadata,
         Column('id', INTEGER(unsigned=True), primary_key=True),
         Column('content', VARCHAR(32), nullable=False, unique=True),
-        Column('references', INTEGER(unique=True), default=0),
+        Column('references', INTEGER, nullable=False, default=0),
 
         Column('_created', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp()),
@@ -653,6 +663,8 @@ tag_mark = Table('tag_mark', metadata,
         Column('_modified', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp(), onupdate=func.unix_timestamp()),
         UniqueConstraint('user_id', 'object_type_id', 'object_pk', 'tag_id'),
+        Index('ix_tag_mark_object_user_created', 'object_type_id', 'object_pk',
+            'user_id', '_created', 'id'),
         mysql_engine = 'InnoDB',
         mysql_charset = 'utf8',
         )
@@ -684,6 +696,7 @@ site_seo = Table('site_seo', metadata,
             default=func.unix_timestamp()),
         Column('_modified', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp(), onupdate=func.unix_timestamp()),
+        Index('ix_site_seo_object', 'object_type_id', 'object_pk'),
         mysql_engine = 'InnoDB',
         mysql_charset = 'utf8',
         )
@@ -708,6 +721,27 @@ site_comment = Table('site_comment', metadata,
             default=func.unix_timestamp()),
         Column('_modified', INTEGER(unsigned=True), nullable=False,
             default=func.unix_timestamp(), onupdate=func.unix_timestamp()),
+        Index('ix_site_comment_object_created', 'object_type_id', 'object_pk',
+            'hide', '_created', 'id'),
+        mysql_engine = 'InnoDB',
+        mysql_charset = 'utf8',
+        )
+
+''' leaderboard.py snapshot, rank 1 first; scope_id 0 for scope 'all' '''
+game_leaderboard = Table('game_leaderboard', metadata,
+        Column('id', INTEGER(unsigned=True), primary_key=True),
+        Column('metric', VARCHAR(16), nullable=False),
+        Column('scope', VARCHAR(16), nullable=False),
+        Column('scope_id', INTEGER(unsigned=True), nullable=False, default=0),
+        Column('rank', INTEGER(unsigned=True), nullable=False),
+        Column('game_id', INTEGER(unsigned=True), ForeignKey('game_detail.id'),
+            nullable=False),
+        Column('value', DECIMAL(precision=14, scale=4), nullable=False),
+        Column('complete', BOOLEAN, nullable=False, default=0), # the board held every game
+
+        Column('_created', INTEGER(unsigned=True), nullable=False,
+            default=func.unix_timestamp()),
+        UniqueConstraint('metric', 'scope', 'scope_id', 'rank'),
         mysql_engine = 'InnoDB',
         mysql_charset = 'utf8',
         )
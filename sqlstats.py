@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# coding: utf-8
+import re
+import time
+import bisect
+import logging
+import threading
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+''' histogram bucket upper bounds, ms '''
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+
+_strings = re.compile(r"'(?:[^']|'')*'")
+_numbers = re.compile(r'\b\d+(?:\.\d+)?\b')
+_in_lists = re.compile(r'\bIN\s*\((?:\s*(?:\?|%s|:\w+)\s*,?)+\)', re.I)
+_spaces = re.compile(r'\s+')
+_fingerprints = {}
+
+def fingerprint(statement):
+    ''' Normalise a statement: literals become ?, IN lists collapse. '''
+    fp = _fingerprints.get(statement)
+    if fp is None:
+        fp = _strings.sub('?', statement)
+        fp = _numbers.sub('?', fp)
+        fp = _in_lists.sub('IN (...)', fp)
+        fp = _spaces.sub(' ', fp).strip()
+        if len(_fingerprints) > 2000:
+            _fingerprints.clear()
+        _fingerprints[statement] = fp
+    return fp
+
+class RequestStats(object):
+    ''' Statements run while handling one request.
+
+    queries: [[fingerprint, seconds, rows]] in execution order
+    fingerprints: {fingerprint: [count, seconds, rows]}
+    Rows are those fetched from statements returning rows, counted as
+    they are fetched, and cursor.rowcount (rows affected) for the rest.
+    '''
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.queries = []
+        self.fingerprints = {}
+
+    def record(self, fp, elapsed, rows):
+        ''' Return the index of the query, for add_rows(). '''
+        self.queries.append([fp, elapsed, rows])
+        entry = self.fingerprints.setdefault(fp, [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += rows
+        return len(self.queries) - 1
+
+    def add_rows(self, index, rows):
+        query = self.queries[index]
+        query[2] += rows
+        self.fingerprints[query[0]][2] += rows
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total(self):
+        return sum(elapsed for fp, elapsed, rows in self.queries)
+
+    @property
+    def rows(self):
+        return sum(rows for fp, elapsed, rows in self.queries)
+
+    @property
+    def n_plus_one(self):
+        ''' [(fingerprint, count)] repeated more than `threshold` times. '''
+        return sorted(((fp, entry[0])
+            for fp, entry in self.fingerprints.iteritems()
+            if entry[0] > self.threshold), key=lambda x: -x[1])
+
+class _CountingCursor(object):
+    ''' DBAPI cursor whose fetches add to the rows of a recorded query;
+    buffered, unbuffered and server-side cursors alike.
+    '''
+
+    def __init__(self, cursor, stats, index):
+        self._cursor = cursor
+        self._stats = stats
+        self._index = index
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _count(self, rows):
+        self._stats.add_rows(self._index, len(rows))
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.add_rows(self._index, 1)
+        return row
+
+    def fetchmany(self, *a):
+        return self._count(self._cursor.fetchmany(*a))
+
+    def fetchall(self):
+        return self._count(self._cursor.fetchall())
+
+class SQLProfiler(object):
+    ''' Per-request statement counts and timings, plus a process-wide
+    per-fingerprint latency histogram.
+
+    One pair of cursor listeners is attached per engine; statements are
+    recorded only on threads inside begin()/end().
+    '''
+
+    def __init__(self, threshold=10):
+        self.threshold = threshold
+        self.histogram = {}
+        self._engines = set()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        with self._lock:
+            if engine in self._engines:
+                return
+            self._engines.add(engine)
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def begin(self):
+        self._local.stats = RequestStats(self.threshold)
+        return self._local.stats
+
+    def end(self):
+        stats, self._local.stats = getattr(self._local, 'stats', None), None
+        if stats is None:
+            return None
+        for fp, count in stats.n_plus_one:
+            log.warning('likely N+1: %d x %s', count, fp)
+        with self._lock:
+            for fp, elapsed, rows in stats.queries:
+                entry = self.histogram.get(fp)
+                if entry is None:
+                    entry = self.histogram[fp] = [0, 0.0, 0, [0] * len(BUCKETS)]
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] += rows
+                entry[3][bisect.bisect_left(BUCKETS, elapsed * 1000)] += 1
+        return stats
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self._local, 'stats', None) is not None:
+            conn.info.setdefault('sqlstats_start', []).append(time.time())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        stats = getattr(self._local, 'stats', None)
+        starts = conn.info.get('sqlstats_start')
+        if stats is None or not starts:
+            return
+        elapsed = time.time() - starts.pop()
+        if cursor.description is None or context is None:
+            stats.record(fingerprint(statement), elapsed,
+                max(cursor.rowcount, 0))
+        else:
+            ''' the result proxy is built from context.cursor next '''
+            context.cursor = _CountingCursor(cursor, stats,
+                stats.record(fingerprint(statement), elapsed, 0))
+
+    def reset(self):
+        with self._lock:
+            self.histogram = {}
+
+    def dump(self, limit=20):
+        ''' Text report of the fingerprints with the most total time. '''
+        with self._lock:
+            items = sorted(self.histogram.iteritems(), key=lambda x: -x[1][1])
+        lines = ['%8s %10s %10s %8s  %s' % ('count', 'total ms', 'avg ms',
+            'rows', 'statement')]
+        for fp, (count, total, rows, buckets) in items[:limit]:
+            lines.append('%8d %10.1f %10.2f %8d  %s' % (
+                count, total * 1000, total * 1000 / count, rows, fp))
+            lines.append('%40s %s' % ('', ' '.join('<%s:%d' % (
+                bound, n) for bound, n in zip(BUCKETS, buckets) if n)))
+        return '\n'.join(lines)
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# coding: utf-8
+""" rollup.py's game_detail score totals against SQLite.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+''' the benchmarks' helpers: package loading and SQLite engines '''
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+from common import load_package, sqlite_engine
+
+package = load_package(os.path.basename(os.path.dirname(HERE)))
+orm, schema, rollup = package.orm, package.schema, package.rollup
+
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sqlite_engine()
+        schema.metadata.create_all(self.engine, tables=[schema.user_base,
+            schema.game_taxonomy, schema.game_detail, schema.game_mark])
+        self.engine.execute(schema.game_taxonomy.insert(),
+            dict(is_genre=1, segment='g', name='genre'))
+        self.engine.execute(schema.game_detail.insert(), [dict(genre_id=1,
+            headline='game %d' % i) for i in range(3)])
+        self.db = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+
+    def totals(self):
+        ''' {game id: (count_score, total_score)} '''
+        gd = schema.game_detail.c
+        return dict((row[0], tuple(row[1:])) for row in self.engine.execute(
+            select([gd.id, gd.count_score, gd.total_score])))
+
+    def mark(self, **kw):
+        kw.setdefault('user_id', 1)
+        kw.setdefault('scored', 1)
+        return orm.GameMark(**kw)
+
+    def test_insert(self):
+        self.db.add_all([self.mark(game_id=1, score=4),
+            self.mark(game_id=1, user_id=2, score=6),
+            self.mark(game_id=2, scored=0, score=9)])
+        self.db.commit()
+        self.assertEqual(self.totals(), {1: (2, 10), 2: (0, 0), 3: (0, 0)})
+
+    def test_update(self):
+        mark = self.mark(game_id=1, score=4)
+        self.db.add(mark)
+        self.db.commit()
+        mark.score = 7
+        self.db.commit()
+        self.assertEqual(self.totals()[1], (1, 7))
+        mark.game_id = 2
+        self.db.commit()
+        self.assertEqual(self.totals()[1], (0, 0))
+        self.assertEqual(self.totals()[2], (1, 7))
+        mark.scored = 0
+        self.db.commit()
+        self.assertEqual(self.totals()[2], (0, 0))
+
+    def test_delete(self):
+        mark = self.mark(game_id=1, score=4)
+        self.db.add(mark)
+        self.db.commit()
+        self.db.delete(mark)
+        self.db.commit()
+        self.assertEqual(self.totals()[1], (0, 0))
+
+    def test_rollback(self):
+        self.db.add(self.mark(game_id=1, score=4))
+        self.db.flush()
+        self.db.rollback()
+        self.db.commit()
+        self.assertEqual(self.totals()[1], (0, 0))
+
+    def test_relationship(self):
+        game = self.db.query(orm.GameDetail).get(1)
+        game.game_marks.append(self.mark(score=4))
+        self.db.commit()
+        self.assertEqual(self.totals()[1], (1, 4))
+        mark = self.mark(user_id=2, score=5)
+        mark.game_detail = self.db.query(orm.GameDetail).get(2)
+        self.db.add(mark)
+        self.db.commit()
+        self.assertEqual(self.totals()[2], (1, 5))
+
+    def test_relationship_move(self):
+        mark = self.mark(game_id=1, score=4)
+        self.db.add(mark)
+        self.db.commit()
+        first, last = self.db.query(orm.GameDetail).get(1),\
+            self.db.query(orm.GameDetail).get(3)
+        mark.game_detail = last
+        self.db.commit()
+        self.assertEqual(self.totals()[1], (0, 0))
+        self.assertEqual(self.totals()[3], (1, 4))
+        first.game_marks.append(mark)
+        self.db.commit()
+        self.assertEqual(mark.game_id, 1)
+        self.assertEqual(self.totals()[1], (1, 4))
+        self.assertEqual(self.totals()[3], (0, 0))
+
+    def test_new_game(self):
+        ''' the parent has no id until the flush '''
+        game = orm.GameDetail(genre_id=1, headline='new')
+        game.game_marks.append(self.mark(score=8))
+        self.db.add(game)
+        self.db.commit()
+        self.assertEqual(self.totals()[game.id], (1, 8))
+
+    def test_rebuild(self):
+        self.engine.execute(schema.game_mark.insert(), [
+            dict(user_id=1, game_id=1, scored=1, score=3),
+            dict(user_id=2, game_id=1, scored=1, score=5),
+            dict(user_id=1, game_id=3, scored=0, score=9)])
+        self.engine.execute(schema.game_detail.update()\
+            .where(schema.game_detail.c.id == 2)\
+            .values(count_score=4, total_score=20))
+        progress = []
+        self.assertEqual(rollup.rebuild(self.engine, chunk=2,
+            progress=lambda last, done: progress.append((last, done))), 3)
+        self.assertEqual(progress, [(2, 2), (3, 3)])
+        self.assertEqual(self.totals(), {1: (2, 8), 2: (0, 0), 3: (0, 0)})
+        self.assertEqual(rollup.rebuild(self.engine, after=2), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# coding: utf-8
+""" upsert, get_or_create and get_or_create_many against SQLite.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects import mysql,\
+                               sqlite
+
+''' the benchmarks' helpers: package loading and SQLite engines '''
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+from common import load_package, sqlite_engine
+
+package = load_package(os.path.basename(os.path.dirname(HERE)))
+orm, schema = package.orm, package.schema
+
+
+class UpsertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sqlite_engine()
+        schema.metadata.create_all(self.engine, tables=[schema.user_base,
+            schema.tag_content, schema.tag_mark, schema.user_relation,
+            schema.site_model])
+        self.db = sessionmaker(bind=self.engine)()
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+            lambda conn, cursor, statement, *a: self.statements.append(
+                statement))
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+
+    def count(self, table):
+        return self.db.execute(table.count()).scalar()
+
+    def test_compiles_scoped_to_key(self):
+        table = schema.tag_content
+        self.assertTrue(str(orm.upsert(table, sqlite.dialect(), ('content',))\
+            .compile(dialect=sqlite.dialect())).endswith(
+                'ON CONFLICT (content) DO NOTHING'))
+        self.assertIn('ON DUPLICATE KEY UPDATE id = tag_content.id',
+            str(orm.upsert(table, mysql.dialect(), ('content',))\
+                .compile(dialect=mysql.dialect())))
+
+    def test_get_or_create(self):
+        tag, created = orm.get_or_create(self.db, orm.TagContent,
+            content=u'a')
+        self.assertTrue(created)
+        self.assertTrue(tag.id)
+        again, created = orm.get_or_create(self.db, orm.TagContent,
+            content=u'a')
+        self.assertFalse(created)
+        self.assertIs(again, tag)
+        self.assertEqual(self.count(schema.tag_content), 1)
+
+    def test_get_or_create_composite_key(self):
+        kw = dict(user_id=1, target_id=2, reverse=0)
+        relation, created = orm.get_or_create(self.db, orm.UserRelation, **kw)
+        self.assertTrue(created)
+        self.assertEqual(orm.get_or_create(self.db, orm.UserRelation, **kw),
+            (relation, False))
+
+    def test_row_inserted_meanwhile(self):
+        ''' the upsert meets a row the first SELECT did not see '''
+        self.db.execute(schema.tag_content.insert(), dict(content=u'b'))
+        query, calls = self.db.query, []
+        def first_misses(*a):
+            calls.append(a)
+            if len(calls) == 1:
+                return query(*a).filter_by(content=None)
+            return query(*a)
+        self.db.query = first_misses
+        try:
+            tag, created = orm.get_or_create(self.db, orm.TagContent,
+                content=u'b')
+        finally:
+            del self.db.query
+        self.assertFalse(created)
+        self.assertEqual(tag.content, u'b')
+        self.assertEqual(self.count(schema.tag_content), 1)
+
+    def test_other_errors_raise(self):
+        ''' NOT NULL is not swallowed as a conflict would be '''
+        self.assertRaises(IntegrityError, orm.get_or_create, self.db,
+            orm.TagContent, content=u'c', references=None)
+
+    def test_without_unique_key(self):
+        mark, created = orm.get_or_create(self.db, orm.TagMark, user_id=1)
+        self.assertTrue(created)
+        self.assertIsNone(mark.id)
+        self.assertNotIn(mark, self.db)
+
+    def test_get_or_create_many(self):
+        self.db.execute(schema.tag_content.insert(), [dict(content=u'%d' % i)
+            for i in range(0, 1200, 3)])
+        rows = [dict(content=u'%d' % (i % 1200)) for i in range(1500)]
+        del self.statements[:]
+        resolved = orm.get_or_create_many(self.db, orm.TagContent, rows,
+            chunk=500)
+        ''' a SELECT, an upsert and a SELECT per chunk of 500 keys '''
+        self.assertEqual(len(self.statements), 9)
+        self.assertEqual(sorted(resolved), sorted(u'%d' % i
+            for i in range(1200)))
+        self.assertEqual(len(set(tag.id for tag in resolved.itervalues())),
+            1200)
+        self.assertEqual(self.count(schema.tag_content), 1200)
+
+    def test_get_or_create_many_composite_key(self):
+        rows = [dict(user_id=1, target_id=i, reverse=0) for i in range(10)]
+        first = orm.get_or_create_many(self.db, orm.UserRelation, rows[:4])
+        resolved = orm.get_or_create_many(self.db, orm.UserRelation, rows)
+        self.assertEqual(sorted(resolved), [(1, i, False) for i in range(10)])
+        for key, relation in first.iteritems():
+            self.assertIs(resolved[key], relation)
+
+    def test_get_or_create_many_unknown_key(self):
+        self.assertRaises(package.base.SqlaException,
+            orm.get_or_create_many, self.db, orm.TagContent,
+            [dict(references=1)])
+
+if __name__ == '__main__':
+    unittest.main()